@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# Name:          benchmark_s1_noise.py
+# Purpose:       Compare the batched Sentinel-1 thermal noise correction
+#                against the former per-sample interpolation, on a synthetic
+#                noise annotation.
+
+import sys
+from datetime import datetime
+from datetime import timedelta
+import numpy as np
+from scipy import interpolate
+from safe_to_netcdf.s1_reader_and_NetCDF_converter import Sentinel1_reader_and_NetCDF_converter
+
+
+class PerSampleNoiseReader(Sentinel1_reader_and_NetCDF_converter):
+    """ Reader using one interpolator per range sample (former implementation) """
+
+    @staticmethod
+    def interpolateNoiseRangeBlock(noiseRangeVectorLine, noiseRangeVectorList, lineIndex):
+        numberOfSamples = noiseRangeVectorList.shape[0]
+        noiseRangeMatrix_ = np.zeros((numberOfSamples, len(lineIndex)))
+        for i in range(numberOfSamples):
+            if len(noiseRangeVectorLine) > 1:
+                intp1_line = interpolate.interp1d(noiseRangeVectorLine,
+                                                  noiseRangeVectorList[i, :],
+                                                  fill_value='extrapolate')
+                noiseRangeMatrix_[i, :] = intp1_line(lineIndex)
+            else:
+                noiseRangeMatrix_[i, :] = noiseRangeVectorList[i]
+        return noiseRangeMatrix_.T
+
+
+def synthetic_noise_annotation(xSize, ySize, swaths=3, recordSpacing=500, pixelSpacing=40):
+    """ Returns a synthetic noise annotation, as given by readNoiseData, and
+        the matching image annotation.
+    """
+    t0 = datetime(2020, 10, 29, 5, 3, 32)
+    delta_ts = 0.002
+    rng = np.random.default_rng(0)
+
+    # Noise in range direction, one record every recordSpacing lines
+    noiseRangeVectorList = {}
+    pixels = np.append(np.arange(0, xSize, pixelSpacing), xSize - 1)
+    for line in range(0, ySize, recordSpacing):
+        azimuthTime = (t0 + timedelta(seconds=line * delta_ts)).strftime('%Y-%m-%dT%H:%M:%S.%f')
+        lut = 300. + 50. * np.cos(pixels / xSize * np.pi) + rng.random(len(pixels))
+        noiseRangeVectorList[azimuthTime] = [str(line), ' '.join(str(p) for p in pixels),
+                                             ' '.join('%e' % v for v in lut)]
+
+    # Noise in azimuth direction, one block per swath
+    noiseAzimuthVectorList = {}
+    bounds = np.linspace(0, xSize, swaths + 1).astype(int)
+    lines = np.append(np.arange(0, ySize, recordSpacing // 4), ySize - 1)
+    for i in range(swaths):
+        lut = 1. + 0.05 * rng.random(len(lines))
+        noiseAzimuthVectorList[i] = {'IW%i' % (i + 1): [
+            '0', str(bounds[i]), str(ySize - 1), str(bounds[i + 1] - 1),
+            ' '.join(str(l) for l in lines), ' '.join('%e' % v for v in lut)]}
+
+    imageAnnotation = {'productFirstLineUtcTime': t0.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                       'azimuthTimeInterval': str(delta_ts)}
+    return {'range': noiseRangeVectorList, 'azimuth': noiseAzimuthVectorList}, imageAnnotation
+
+
+def run(reader_class, noiseVector, imageAnnotation, xSize, ySize):
+    # No SAFE product, only what the noise correction needs
+    noiseCorrectionMatrix = np.zeros((ySize, xSize), np.float32)
+    start = datetime.now()
+    reader_class.computeNoiseCorrectionMatrix(noiseVector, imageAnnotation, xSize, ySize,
+                                              noiseCorrectionMatrix)
+    return noiseCorrectionMatrix, datetime.now() - start
+
+
+if __name__ == '__main__':
+
+    xSize, ySize = 6000, 4000
+    if len(sys.argv) == 3:
+        xSize, ySize = int(sys.argv[1]), int(sys.argv[2])
+
+    noiseVector, imageAnnotation = synthetic_noise_annotation(xSize, ySize)
+    batched, batched_time = run(Sentinel1_reader_and_NetCDF_converter, noiseVector,
+                                imageAnnotation, xSize, ySize)
+    per_sample, per_sample_time = run(PerSampleNoiseReader, noiseVector, imageAnnotation,
+                                      xSize, ySize)
+
+    print(f'Scene: {xSize} x {ySize}')
+    print(f'Per-sample interpolation: {per_sample_time}')
+    print(f'Batched interpolation: {batched_time}')
+    print(f'Identical output: {np.array_equal(batched, per_sample)}')
@@ -8,6 +8,11 @@ Constants describing Sentinel satellites
 
 platform_id = {"Sentinel-2A": 0, "Sentinel-2B": 1, "Sentinel-2C": 2, "Sentinel-2D": 3}
 
+# Manifest data objects read by the converters, by mime type: xml and gml files, and images
+# opened with gdal. Quick-looks, html and kml files are not extracted when extracting only what
+# is needed
+safe_data_mime_types = ['text/xml', 'application/xml', 'application/octet-stream']
+
 # ------------- Sentinel 2 -------------
 
 # Bands order
@@ -19,6 +24,15 @@ s2_bands_aliases = {'B01': 'B1', 'B02': 'B2', 'B03': 'B3', 'B04': 'B4', 'B05': '
                     'B07': 'B7', 'B08': 'B8', 'B8A': 'B8A', 'B09': 'B9', 'B10': 'B10', 'B11': 'B11',
                     'B12': 'B12'}
 
+# Masks with one boolean layer per band, that can be packed in a bitfield variable
+s2_packed_mask_types = ['DEFECT', 'NODATA', 'SATURA', 'TECQUA']
+
+# Raster masks (processing baseline 04.00 onward): flag meaning of each band
+s2_raster_mask_bands = {'MSK_QUALIT': ['ANC_LOST', 'ANC_DEG', 'MSI_LOST', 'MSI_DEG',
+                                       'QT_DEFECTIVE_PIXELS', 'QT_NODATA_PIXELS',
+                                       'QT_PARTIALLY_CORRECTED_PIXELS', 'QT_SATURATED_PIXELS'],
+                        'MSK_CLASSI': ['OPAQUE', 'CIRRUS', 'SNOW_ICE']}
+
 # L2A: layers
 s2_l2a_layers = {"MSK_CLDPRB_20m": "MSK_CLDPRB, Cloud Probabilities",
               "MSK_SNWPRB_20m": "MSK_SNWPRB, Snow Probabilities",
@@ -0,0 +1,431 @@
+#!/usr/bin/python3
+
+# Name:          metadata.py
+# Purpose:       Read the global attributes and footprint of Sentinel-1 and
+#                Sentinel-2 SAFE products straight from the zip files, for
+#                cataloguing products without converting them.
+#
+#                Only manifest.safe and the product level XML files are read:
+#                no extraction, and neither gdal, scipy nor netCDF4 needed.
+#                Global attributes are the ones the converters write, the
+#                gdal SAFE and SENTINEL2 drivers metadata included.
+
+import sys
+import pathlib
+import zipfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import lxml.etree as ET
+
+
+def conversion_attributes(product_id, nowstr):
+    """
+    Global attributes added by the converters to the ones read from the product, with the
+    default conversion options (Conventions CF-1.6).
+    Args:
+        product_id: SAFE product name
+        nowstr: conversion time, as string
+    Returns:
+        dictionary of attributes
+    """
+    attributes = {'Conventions': "CF-1.6"}
+    if product_id.startswith('S1'):
+        attributes['summary'] = 'Sentinel-1 C-band SAR GRD product.'
+        attributes['keywords'] = \
+            '[Earth Science, Spectral/Engineering, RADAR, RADAR backscatter], ' \
+            '[Earth Science, Spectral/Engineering, RADAR, RADAR imagery], ' \
+            '[Earth Science, Spectral/Engineering, Microwave, Microwave Imagery]'
+    else:
+        attributes['summary'] = 'Sentinel-2 Multi-Spectral Instrument {} product.'.format(
+            processing_level(product_id))
+        attributes['keywords'] = \
+            '[Earth Science, Atmosphere, Atmospheric radiation, Reflectance]'
+    attributes['keywords_vocabulary'] = "GCMD Science Keywords"
+    attributes['institution'] = "Norwegian Meteorological Institute"
+    attributes['history'] = nowstr + ". Converted from SAFE to NetCDF by NBS team."
+    if not product_id.startswith('S1'):
+        attributes['source'] = "surface observation"
+    return attributes
+
+
+def processing_level(product_id):
+    """ Sentinel-2 processing level, e.g. Level-1C """
+    return 'Level-' + product_id.split('_')[1][4:6]
+
+
+def text(element):
+    """ Text of an element without children nor attributes, as read by gdal, or None """
+    if element is None or len(element) or element.attrib or element.text is None:
+        return None
+    return element.text
+
+
+def strip_namespaces(root):
+    """ Remove the namespaces of the elements names, as gdal does, and return root """
+    for element in root.iter():
+        if isinstance(element.tag, str):
+            element.tag = ET.QName(element).localname
+    return root
+
+
+def children(element):
+    """ Child elements (without comments) of an element, or none if it is None """
+    if element is None:
+        return []
+    return [child for child in element if isinstance(child.tag, str)]
+
+
+class SafeZip:
+    """
+    XML files of a zipped SAFE product, read from the zip file without extracting it.
+    """
+
+    def __init__(self, input_zip):
+        self.input_zip = pathlib.Path(input_zip)
+        self.product_id = self.input_zip.stem
+        self.zip = zipfile.ZipFile(self.input_zip)
+        self.names = self.zip.namelist()
+        self.SAFE_dir = self.names[0].split('/')[0]
+        self.dterrengdata = f'{self.SAFE_dir}/manifest.safe' not in self.names
+        if self.dterrengdata:
+            self.manifest = self.xml('MTD_MSIL1C.xml')
+        else:
+            self.manifest = self.xml('manifest.safe')
+        self.product_root = None
+
+    def xml(self, path):
+        """
+        Args:
+            path: path relative to the SAFE directory
+        Returns:
+            root element of the XML file
+        """
+        return ET.fromstring(self.zip.read(f'{self.SAFE_dir}/{path}'))
+
+    def data_objects(self, rep_id):
+        """
+        Args:
+            rep_id: repID (S1) or ID (S2) of data objects in the manifest
+        Returns:
+            list of paths relative to the SAFE directory, in manifest order
+        """
+        paths = []
+        for dataObject in self.manifest.find('./dataObjectSection').findall('./'):
+            if rep_id not in (dataObject.attrib.get('repID'), dataObject.attrib.get('ID')):
+                continue
+            for element in dataObject.iter():
+                if 'href' in element.attrib:
+                    paths.append(element.attrib['href'][2:])
+        return paths
+
+    def metadata_object(self, object_id):
+        """ xmlData element of a manifest metadata object, or None """
+        for metadataObject in self.manifest.iterfind('./metadataSection/metadataObject'):
+            if metadataObject.attrib.get('ID') == object_id:
+                return metadataObject.find('./metadataWrap/xmlData')
+        return None
+
+    def product_xml(self):
+        """ Root of the Sentinel-2 product level XML file, without namespaces """
+        if self.product_root is None:
+            if self.dterrengdata:
+                path = 'MTD_MSIL1C.xml'
+            else:
+                level = processing_level(self.product_id)
+                path = self.data_objects(f'S2_{level}_Product_Metadata')[0]
+            self.product_root = strip_namespaces(self.xml(path))
+        return self.product_root
+
+    def close(self):
+        self.zip.close()
+
+
+def s1_attributes(product, nowstr):
+    """
+    Global attributes of a Sentinel-1 product: gdal SAFE driver metadata, and those added by
+    utils.initializer and write_to_NetCDF.
+    Args:
+        product: SafeZip
+        nowstr: conversion time, as string
+    Returns:
+        dictionary of attributes
+    """
+    attributes = {}
+    ns = product.manifest.nsmap
+
+    def value(element, path, default=''):
+        found = None if element is None else element.find(path, namespaces=ns)
+        return default if found is None or found.text is None else found.text
+
+    # Image annotation files, the last one gives the values as in gdal
+    for path in product.data_objects('s1Level1ProductSchema'):
+        root = product.xml(path)
+        attributes['PRODUCT_TYPE'] = value(root, './adsHeader/productType', 'UNK')
+        attributes['MISSION_ID'] = value(root, './adsHeader/missionId', 'UNK')
+        attributes['MODE'] = value(root, './adsHeader/mode', 'UNK')
+        attributes['SWATH'] = value(root, './adsHeader/swath', 'UNK')
+        information = root.find('./imageAnnotation/imageInformation')
+        attributes['LINE_SPACING'] = value(information, './azimuthPixelSpacing')
+        attributes['PIXEL_SPACING'] = value(information, './rangePixelSpacing')
+
+    facility = product.metadata_object('processing')
+    if facility is not None:
+        facility = facility.find('./safe:processing/safe:facility', namespaces=ns)
+    if facility is not None:
+        attributes['FACILITY_IDENTIFIER'] = '{}, {}'.format(facility.attrib.get('name', ''),
+                                                            facility.attrib.get('country', ''))
+
+    period = product.metadata_object('acquisitionPeriod')
+    if period is not None:
+        attributes['ACQUISITION_START_TIME'] = value(period,
+                                                     './safe:acquisitionPeriod/safe:startTime')
+        attributes['ACQUISITION_STOP_TIME'] = value(period,
+                                                    './safe:acquisitionPeriod/safe:stopTime')
+
+    platform = product.metadata_object('platform')
+    if platform is not None:
+        attributes['SATELLITE_IDENTIFIER'] = value(platform, './safe:platform/safe:familyName')
+        family = platform.find('./safe:platform/safe:instrument/safe:familyName', namespaces=ns)
+        attributes['SENSOR_IDENTIFIER'] = '' if family is None else family.attrib.get(
+            'abbreviation', '')
+        mode = './safe:platform/safe:instrument/safe:extension/s1sarl1:instrumentMode/'
+        attributes['BEAM_MODE'] = value(platform, mode + 's1sarl1:mode', 'UNK')
+        attributes['BEAM_SWATH'] = value(platform, mode + 's1sarl1:swath', 'UNK')
+
+    orbit = product.metadata_object('measurementOrbitReference')
+    if orbit is not None:
+        attributes['ORBIT_NUMBER'] = value(orbit, './safe:orbitReference/safe:orbitNumber')
+        attributes['ORBIT_DIRECTION'] = value(
+            orbit, './safe:orbitReference/safe:extension/s1:orbitProperties/s1:pass')
+
+    # Added by utils.initializer, to be identical to python2/Xenial
+    polarisations = product.manifest.findall('.//s1sarl1:transmitterReceiverPolarisation',
+                                             namespaces=ns)
+    attributes['polarisation'] = [''.join(p.text for p in polarisations)]
+    attributes['ProductTimelinessCategory'] = product.manifest.find(
+        './/s1sarl1:productTimelinessCategory', namespaces=ns).text
+
+    attributes.update(conversion_attributes(product.product_id, nowstr))
+    return attributes
+
+
+def s2_user_product_metadata(root):
+    """
+    gdal SENTINEL2 driver metadata of a product level XML file (MTD_MSIL1C.xml, ...).
+    Args:
+        root: root element of the file, without namespaces
+    Returns:
+        dictionary of metadata
+    """
+    metadata = {}
+
+    def add_texts(element):
+        for child in children(element):
+            if text(child) is not None:
+                metadata[child.tag] = text(child)
+
+    datatakes = 0
+    for child in children(root.find('./General_Info/Product_Info')):
+        if text(child) is not None:
+            metadata[child.tag] = text(child)
+        elif child.tag == 'Datatake':
+            datatakes += 1
+            prefix = f'DATATAKE_{datatakes}_'
+            if 'datatakeIdentifier' in child.attrib:
+                metadata[prefix + 'ID'] = child.attrib['datatakeIdentifier']
+            for child2 in children(child):
+                if text(child2) is not None:
+                    metadata[prefix + child2.tag] = text(child2)
+
+    characteristics = root.find('./General_Info/Product_Image_Characteristics')
+    if characteristics is None:
+        characteristics = root.find('./General_Info/L2A_Product_Image_Characteristics')
+    for child in children(characteristics):
+        if child.tag == 'Special_Values':
+            special_text = child.findtext('./SPECIAL_VALUE_TEXT')
+            special_index = child.findtext('./SPECIAL_VALUE_INDEX')
+            if special_text is not None and special_index is not None:
+                metadata['SPECIAL_VALUE_' + special_text] = special_index
+    if characteristics is not None:
+        quantification = characteristics.findtext('./QUANTIFICATION_VALUE')
+        if quantification is not None:
+            metadata['QUANTIFICATION_VALUE'] = quantification
+        reflectance_u = characteristics.findtext('./Reflectance_Conversion/U')
+        if reflectance_u is not None:
+            metadata['REFLECTANCE_CONVERSION_U'] = reflectance_u
+        # L2A quantification values
+        values = characteristics.find('./L1C_L2A_Quantification_Values_List')
+        if values is None:
+            values = characteristics.find('./Quantification_Values_List')
+        for child in children(values):
+            metadata[child.tag] = child.text
+
+    quality = root.find('./Quality_Indicators_Info')
+    add_texts(quality)
+    if quality is not None:
+        add_texts(quality.find('./Technical_Quality_Assessment'))
+        for child in children(
+                quality.find('./Quality_Control_Checks/Quality_Inspections')):
+            if 'checkType' in child.attrib:
+                # <quality_check checkType="...">PASSED</quality_check>
+                metadata[child.attrib['checkType']] = child.text
+            elif text(child) is not None:
+                metadata[child.tag] = text(child)
+        content = quality.find('./Image_Content_QI')
+        if content is None:
+            content = quality.find('./L2A_Image_Content_QI')
+        add_texts(content)
+
+    wkt = s2_footprint(root)
+    if wkt is not None:
+        metadata['FOOTPRINT'] = wkt
+    return metadata
+
+
+def s2_attributes(product, nowstr):
+    """
+    Global attributes of a Sentinel-2 product: gdal SENTINEL2 driver metadata, and those
+    added by write_to_NetCDF.
+    Args:
+        product: SafeZip
+        nowstr: conversion time, as string
+    Returns:
+        dictionary of attributes
+    """
+    attributes = s2_user_product_metadata(product.product_xml())
+    attributes.update(conversion_attributes(product.product_id, nowstr))
+    if not product.dterrengdata:
+        orbit = product.manifest.find('.//safe:orbitNumber', namespaces=product.manifest.nsmap)
+        if orbit is not None:
+            attributes['orbitNumber'] = orbit.text
+    relative_orbit = attributes.pop('DATATAKE_1_SENSING_ORBIT_NUMBER', None)
+    if relative_orbit is not None:
+        attributes['relativeOrbitNumber'] = relative_orbit
+    return attributes
+
+
+def s2_footprint(root):
+    """
+    Footprint of a Sentinel-2 product, as given by gdal.
+    Args:
+        root: root element of the product level XML file, without namespaces
+    Returns:
+        WKT polygon in longitude, latitude, or None
+    """
+    positions = root.find('./Geometric_Info/Product_Footprint/Product_Footprint/'
+                          'Global_Footprint/EXT_POS_LIST')
+    if positions is None or not positions.text:
+        return None
+    values = positions.text.split()
+    points = [f'{values[i + 1]} {values[i]}' for i in range(0, len(values) - 1, 2)]
+    return 'POLYGON(({}))'.format(', '.join(points))
+
+
+def s1_footprint(product):
+    """
+    Footprint of a Sentinel-1 product, from the manifest measurement frame.
+    Args:
+        product: SafeZip
+    Returns:
+        WKT polygon in longitude, latitude, or None
+    """
+    coordinates = product.manifest.find('.//gml:coordinates', namespaces=product.manifest.nsmap)
+    if coordinates is None or not coordinates.text:
+        return None
+    points = [point.split(',') for point in coordinates.text.split()]
+    # Closed polygon
+    points.append(points[0])
+    return 'POLYGON(({}))'.format(', '.join(f'{lon} {lat}' for lat, lon in points))
+
+
+def global_attributes(input_zip, nowstr=None):
+    """
+    Global attributes the converters would write in the NetCDF file of a product, with the
+    default conversion options (Conventions CF-1.6).
+    Args:
+        input_zip: path to the zipped SAFE product
+        nowstr: conversion time written in history, as string. Default: now
+    Returns:
+        dictionary of attributes
+    """
+    product = SafeZip(input_zip)
+    try:
+        return read_attributes(product, nowstr)
+    finally:
+        product.close()
+
+
+def read_attributes(product, nowstr=None):
+    """ Same as global_attributes, for a SafeZip """
+    if nowstr is None:
+        nowstr = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    if product.product_id.startswith('S1'):
+        return s1_attributes(product, nowstr)
+    return s2_attributes(product, nowstr)
+
+
+def read_footprint(product):
+    """ Footprint of a SafeZip, WKT polygon in longitude, latitude, or None """
+    if product.product_id.startswith('S1'):
+        return s1_footprint(product)
+    return s2_footprint(product.product_xml())
+
+
+def footprint(input_zip):
+    """
+    Args:
+        input_zip: path to the zipped SAFE product
+    Returns:
+        footprint of the product, WKT polygon in longitude, latitude, or None
+    """
+    product = SafeZip(input_zip)
+    try:
+        return read_footprint(product)
+    finally:
+        product.close()
+
+
+def catalogue_entry(input_zip):
+    """
+    Args:
+        input_zip: path to the zipped SAFE product
+    Returns:
+        dictionary of product_id, global_attributes and footprint, or product_id and error
+        if the product could not be read
+    """
+    product_id = pathlib.Path(input_zip).stem
+    try:
+        product = SafeZip(input_zip)
+        try:
+            return {'product_id': product_id,
+                    'global_attributes': read_attributes(product),
+                    'footprint': read_footprint(product)}
+        finally:
+            product.close()
+    except Exception as error:
+        print(f'Could not read {input_zip}: {error!r}')
+        return {'product_id': product_id, 'error': repr(error)}
+
+
+def catalogue(indir, workers=4, pattern='S[12]*.zip'):
+    """
+    Read the metadata of all zipped SAFE products of a directory, in a process pool.
+    Args:
+        indir: directory of zip files
+        workers: number of processes, products read in this process if 1
+        pattern: glob pattern of the zip files
+    Returns:
+        iterator over catalogue entries (see catalogue_entry), in file name order
+    """
+    zips = sorted(pathlib.Path(indir).glob(pattern))
+    if workers <= 1:
+        yield from map(catalogue_entry, zips)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        yield from pool.map(catalogue_entry, zips, chunksize=16)
+
+
+if __name__ == '__main__':
+
+    for entry in catalogue(sys.argv[1]):
+        print(entry)
@@ -18,7 +18,65 @@ import netCDF4
 import numpy as np
 from scipy import interpolate
 import pathlib
+import threading
 import safe_to_netcdf.utils as utils
+import safe_to_netcdf.metadata as metadata
+
+
+class CalibrationInterpolator:
+    """
+        Bicubic interpolation of calibration LUTs from their pixel/line grid
+        to the full image grid.
+
+        Gives the same spline as a RectBivariateSpline fitted on each LUT, but
+        the interpolation is separable: the B-spline basis of each axis and
+        the inverse of its interpolation matrix only depend on the grid, and
+        are computed once. Each LUT then costs a few matrix products.
+
+        Keyword arguments:
+        pixels, lines -- flattened calibration grid, as in xmlCalPixelLines
+        xSize, ySize -- image size
+    """
+
+    def __init__(self, pixels, lines, xSize, ySize):
+        nb_pixels = (pixels == 0).sum()
+        nb_lines = (lines == 0).sum()
+        self.shape = (nb_pixels, nb_lines)
+        self.xSize = xSize
+        self.ySize = ySize
+        self.lineInverse, self.lineBasis = self.getBasis(lines[0::nb_lines], ySize)
+        self.pixelInverse, self.pixelBasis = self.getBasis(pixels[0:nb_lines], xSize)
+
+    @staticmethod
+    def getBasis(points, size, k=3):
+        """ Returns the inverse interpolation matrix on the grid points and the
+            sparse B-spline basis on the image indices, for the knots chosen by
+            RectBivariateSpline (not-a-knot interpolation)."""
+        points = np.asarray(points, float)
+        knots = np.concatenate(([points[0]] * (k + 1), points[2:-2], [points[-1]] * (k + 1)))
+        interpolation = interpolate.BSpline.design_matrix(points, knots, k).toarray()
+        # As RectBivariateSpline, values outside the grid are taken at its edge
+        indices = np.clip(np.arange(size), knots[k], knots[-k - 1])
+        basis = interpolate.BSpline.design_matrix(indices, knots, k)
+        return np.linalg.inv(interpolation), basis
+
+    def __call__(self, cal_tables, first_row=0, last_row=None):
+        """ Returns the interpolated LUTs for image rows first_row to
+            last_row (excluded), as a list of (rows, xSize) arrays.
+
+            Keyword arguments:
+            cal_tables -- flattened LUTs sharing this grid
+        """
+        if last_row is None:
+            last_row = self.ySize
+        coefficients = [self.lineInverse @ cal_table.reshape(self.shape) @ self.pixelInverse.T
+                        for cal_table in cal_tables]
+        # One product along lines for all LUTs, then one per LUT along pixels
+        lineBasis = self.lineBasis[first_row:last_row]
+        rows = lineBasis @ np.hstack(coefficients)
+        nb_coefficients = coefficients[0].shape[1]
+        return [(self.pixelBasis @ rows[:, i * nb_coefficients:(i + 1) * nb_coefficients].T).T
+                for i in range(len(cal_tables))]
 
 
 class Sentinel1_reader_and_NetCDF_converter:
@@ -33,43 +91,99 @@ class Sentinel1_reader_and_NetCDF_converter:
         Keyword arguments:
         SAFE_file -- absolute path to zipped file
         SAFE_outpath -- output storage location for unzipped SAFE product
+        extract -- True to extract the whole product, 'needed' to extract only the files
+                   used by the converter, False to read it in place from the zip file
+        cache -- utils.SafeCache where the product is extracted instead of SAFE_outpath,
+                 shared with other processes. Cannot be used with extract=False
+        lazy -- do not read the product when created: each group of attributes (e.g. GCPs,
+                calibration tables, angles) is read when first used
     """
 
-    def __init__(self, product, indir, outdir):
+    # Attributes loaded on first access by lazy readers, and their loaders
+    mainXML = utils.LazyAttribute('loadProduct')
+    xmlFiles = utils.LazyAttribute('loadProduct')
+    globalAttribs = utils.LazyAttribute('loadProduct')
+    src = utils.LazyAttribute('loadProduct')
+    polarisation = utils.LazyAttribute('loadProduct')
+    xSize = utils.LazyAttribute('loadProduct')
+    ySize = utils.LazyAttribute('loadProduct')
+    gcps = utils.LazyAttribute('loadGCPs')
+    xmlGCPs = utils.LazyAttribute('loadGCPs')
+    xmlCalPixelLines = utils.LazyAttribute('loadCalibration')
+    xmlCalLUTs = utils.LazyAttribute('loadCalibration')
+    noiseVectors = utils.LazyAttribute('loadNoise')
+    imageAnnotation = utils.LazyAttribute('loadNoise')
+    productMetadata = utils.LazyAttribute('loadProductMetadata')
+    productMetadataList = utils.LazyAttribute('loadProductMetadata')
+
+    def __init__(self, product, indir, outdir, extract=True, cache=None, lazy=False):
         self.product_id = product
         self.input_zip = (indir / product).with_suffix('.zip')
         self.SAFE_dir = (outdir / self.product_id).with_suffix('.SAFE')
-        self.gcps = []  # GCPs from gdal used for generation of lat lon
-        self.polarisation = []
-        self.xSize = None
-        self.ySize = None
-        self.xmlFiles = defaultdict(list)
-        self.globalAttribs = {}
-        self.src = None
+        self.extract = extract
+        self.cache = cache
+        self.archive = None  # utils.SafeArchive when reading the zip file in place
+        self.extracted = False  # SAFE_dir extracted by this reader, removed by clean
         self.t0 = datetime.now()
         self.ncout = None  # NetCDF output file
-        self.xmlCalPixelLines = defaultdict(list)
-        self.xmlCalLUTs = defaultdict(list)
-        self.xmlGCPs = defaultdict(list)
-        self.imageAnnotation = defaultdict(dict)
-        self.noiseVectors = defaultdict(list)
-        self.productMetadata = defaultdict(dict)  # list of values from image annotation files
-        self.productMetadataList = defaultdict(dict)  # list of lists from image annotation files
-        self.main()
+        self.calInterpolators = {}  # CalibrationInterpolator for each calibration grid
+        self.annotations = utils.XmlStore()  # annotation files, parsed once
+        self.lock = threading.RLock()  # held while loading attributes
+        self.loaded = set()
+        self.loading = set()
+        if not lazy:
+            self.main()
 
     def main(self):
         """ Main method for traversing and reading key parameters from SAFE
             directory.
         """
+        utils.load(self, 'loadProduct')
+        utils.load(self, 'loadGCPs')
+        utils.load(self, 'loadCalibration')
+        utils.load(self, 'loadNoise')
+        utils.load(self, 'loadProductMetadata')
+        print(f'Annotation files: {self.annotations}')
+
+    def loadProduct(self):
+        """ Uncompress the SAFE product and read the manifest and global attributes """
+        self.polarisation = []
+        self.xSize = None
+        self.ySize = None
+        self.xmlFiles = defaultdict(list)
+        self.globalAttribs = {}
+        self.src = None
 
         # 1) Fetch manifest.xml file
         utils.uncompress(self)
+        self.annotations.archive = self.archive
 
         # 2) Set some of the gloal parameters
         utils.initializer(self)
 
+    def loadGCPs(self):
+        """ Read the GCPs of the product, from gdal and from the annotation files """
+        self.gcps = []  # GCPs from gdal used for generation of lat lon
+        self.xmlGCPs = defaultdict(list)
         gcps_ok = self.getGCPs()
 
+        # Retrieve GCP parameters
+        gcp_parameters = ['azimuthTime', 'slantRangeTime', 'line', 'pixel',
+                          'latitude', 'longitude', 'height', 'incidenceAngle', 'elevationAngle']
+        for xmlFile in self.xmlFiles['s1Level1ProductSchema']:
+            polarisation, gcpValues = self.getGCPValues(xmlFile, gcp_parameters)
+
+            for parameter, values in gcpValues.items():
+                if not parameter == 'azimuthTime':
+                    self.xmlGCPs[str(parameter + '_' + polarisation)] = np.array(values, np.float32)
+                else:
+                    self.xmlGCPs[str(parameter + '_' + polarisation)] = np.array(values, np.str)
+
+    def loadCalibration(self):
+        """ Read the calibration tables of each polarisation """
+        self.xmlCalPixelLines = defaultdict(list)
+        self.xmlCalLUTs = defaultdict(list)
+
         # Calibration tables
         calibrationTables = ['sigmaNought', 'betaNought', 'gamma', 'dn']
         for calXmlFile in self.xmlFiles['s1Level1CalibrationSchema']:
@@ -81,26 +195,24 @@ class Sentinel1_reader_and_NetCDF_converter:
                                                    np.array(cal_lines, np.int16)]
 
             # Retrieve Look Up Tables
+            calTables = self.getCalTables(calXmlFile, calibrationTables)
             for ct in calibrationTables:
-                self.xmlCalLUTs[str(ct + '_' + polarisation)] = np.array(self.getCalTable(calXmlFile, ct), np.float32)
+                self.xmlCalLUTs[str(ct + '_' + polarisation)] = np.array(calTables[ct], np.float32)
+
+    def loadNoise(self):
+        """ Read the thermal noise vectors, and the image annotations they refer to """
+        self.noiseVectors = defaultdict(list)
+        self.imageAnnotation = defaultdict(dict)
 
         # Retrieve thermal noise vectors
         for nXmlFile in self.xmlFiles['s1Level1NoiseSchema']:
             noiseVector, polarisation = self.readNoiseData(nXmlFile)
             self.noiseVectors[str(polarisation)] = noiseVector
 
-        # Retrieve GCP parameters
-        gcp_parameters = ['azimuthTime', 'slantRangeTime', 'line', 'pixel',
-                          'latitude', 'longitude', 'height', 'incidenceAngle', 'elevationAngle']
-        for xmlFile in self.xmlFiles['s1Level1ProductSchema']:
-
-            for parameter in gcp_parameters:
-                polarisation, values = self.getGCPValues(xmlFile, parameter)
-
-                if not parameter == 'azimuthTime':
-                    self.xmlGCPs[str(parameter + '_' + polarisation)] = np.array(values, np.float32)
-                else:
-                    self.xmlGCPs[str(parameter + '_' + polarisation)] = np.array(values, np.str)
+    def loadProductMetadata(self):
+        """ Read the product metadata of the image annotation files """
+        self.productMetadata = defaultdict(dict)  # list of values from image annotation files
+        self.productMetadataList = defaultdict(dict)  # list of lists from image annotation files
 
         # retrieve product metadata from image annotation files
         productMetadata_parameters = [
@@ -141,7 +253,7 @@ class Sentinel1_reader_and_NetCDF_converter:
             'coordinateConversionList', 'swathMergeList']
 
         for xmlFile in self.xmlFiles['s1Level1ProductSchema']:
-            root = utils.xml_read(xmlFile)
+            root = self.annotations.get(xmlFile)
             polarisation = root.find('.//polarisation').text
 
             for pm in productMetadata_parameters:
@@ -272,12 +384,18 @@ class Sentinel1_reader_and_NetCDF_converter:
         else:
             return False
 
-    def write_to_NetCDF(self, nc_outpath, compression_level, chunk_size=(1, 31, 33)):
+    def write_to_NetCDF(self, nc_outpath, compression_level, chunk_size=(1, 31, 33),
+                        sparse_luts=False, workers=1):
         """ Method intitializing output NetCDF product.
 
         Keyword arguments:
         nc_outpath -- output path where NetCDF file should be stored
         compression_level -- compression level on output NetCDF file (1-9)
+        sparse_luts -- store calibration and noise vectors at their native
+                       resolution instead of full resolution layers. Use
+                       rebuild_full_grid to get the full resolution layers.
+        workers -- number of threads computing the calibration, noise and
+                   subswath layers of the polarisations at the same time
         """
 
         print("------------START CONVERSION FROM SAFE TO NETCDF-------------")
@@ -304,20 +422,15 @@ class Sentinel1_reader_and_NetCDF_converter:
         # Status
         utils.memory_use(self.t0)
 
-        lat, lon = self.genLatLon_regGrid()  # Assume gcps are on a regular grid
         nclat.long_name = 'latitude'
         nclat.units = 'degrees_north'
         nclat.standard_name = 'latitude'
-        nclat[:, :] = lat
-
-        del lat
 
         nclon.long_name = 'longitude'
         nclon.units = 'degrees_east'
         nclon.standard_name = 'longitude'
-        nclon[:, :] = lon
 
-        del lon
+        self.writeLatLon_regGrid(nclat, nclon)  # Assume gcps are on a regular grid
 
         # Add raw measurement layers
         ##########################################################
@@ -337,8 +450,8 @@ class Sentinel1_reader_and_NetCDF_converter:
             var.grid_mapping = "crsWGS84"
             var.standard_name = "surface_backwards_scattering_coefficient_of_radar_wave"
             var.polarisation = "%s" % band_metadata['POLARISATION']
-            print((band.GetVirtualMemArray().shape))
-            var[0, :, :] = band.GetVirtualMemArray()
+            print((band.YSize, band.XSize))
+            utils.copy_band(band, var, index=(0,))
 
             band = None
 
@@ -355,23 +468,30 @@ class Sentinel1_reader_and_NetCDF_converter:
         print('\nAdding calibration layers')
         utils.memory_use(self.t0)
 
-        for calibration in self.xmlCalLUTs:
-            current_polarisation = calibration.split('_')[-1]
-            pixels, lines = self.xmlCalPixelLines[current_polarisation]
-            calibration_LUT = self.xmlCalLUTs[calibration]
-            resampled_calibration = self.getCalLayer(pixels, lines, calibration_LUT)
-
-            var = ncout.createVariable(str(calibration), 'f4', ('time', 'y', 'x',),
-                                       zlib=True, complevel=compression_level,
-                                       chunksizes=chunk_size)
-            var.long_name = '%s calibration table' % calibration
-            var.units = "1"
-            var.coordinates = "lat lon"
-            var.grid_mapping = "crsWGS84"
-            var.polarisation = "%s" % current_polarisation
-            var[0, :, :] = resampled_calibration
-
-            del resampled_calibration
+        # Layers are computed by tasks, run once all variables are defined
+        tasks = []
+
+        for polarisation in self.xmlCalPixelLines:
+            if sparse_luts:
+                self.writeSparseCalibration(ncout, polarisation, compression_level)
+                continue
+            calibrations = [c for c in self.xmlCalLUTs if c.split('_')[-1] == polarisation]
+            variables = []
+            for calibration in calibrations:
+                var = ncout.createVariable(str(calibration), 'f4', ('time', 'y', 'x',),
+                                           zlib=True, complevel=compression_level,
+                                           chunksizes=chunk_size)
+                var.long_name = '%s calibration table' % calibration
+                var.units = "1"
+                var.coordinates = "lat lon"
+                var.grid_mapping = "crsWGS84"
+                var.polarisation = "%s" % polarisation
+                variables.append(var)
+
+            tasks.append(lambda target, polarisation=polarisation, variables=variables:
+                         self.writeCalibrationLayers(polarisation,
+                                                     [target(var) for var in variables],
+                                                     4 * chunk_size[1]))
 
         # Add noise layers
         ##########################################################
@@ -380,9 +500,9 @@ class Sentinel1_reader_and_NetCDF_converter:
         utils.memory_use(self.t0)
 
         for polarisation in self.polarisation:
-            noiseCorrectionMatrix = self.getNoiseCorrectionMatrix(self.noiseVectors[polarisation],
-                                                                  polarisation)
-
+            if sparse_luts:
+                self.writeSparseNoise(ncout, polarisation, compression_level)
+                continue
             var = ncout.createVariable(str('noiseCorrectionMatrix_' + polarisation), 'f4',
                                        ('time', 'y', 'x',),
                                        zlib=True, complevel=compression_level,
@@ -392,9 +512,9 @@ class Sentinel1_reader_and_NetCDF_converter:
             var.coordinates = "lat lon"
             var.grid_mapping = "crsWGS84"
             var.polarisation = "%s" % polarisation
-            var[0, :, :] = noiseCorrectionMatrix
-
-            del noiseCorrectionMatrix
+            tasks.append(lambda target, polarisation=polarisation, var=var:
+                         self.writeNoiseCorrectionMatrix(self.noiseVectors[polarisation],
+                                                         polarisation, target(var)))
 
         # Add subswath layers
         ##########################################################
@@ -403,7 +523,7 @@ class Sentinel1_reader_and_NetCDF_converter:
         utils.memory_use(self.t0)
 
         for polarisation in self.polarisation:
-            swathLayer, flags = self.getSwathList(polarisation)
+            flags = self.getSwathFlags()
             flag_values = np.array(sorted(flags.values()), dtype=np.int8)
             flags_meanings = ""
             for key in sorted(flags.keys()):
@@ -420,9 +540,15 @@ class Sentinel1_reader_and_NetCDF_converter:
             swathList.coordinates = "lat lon"
             swathList.grid_mapping = "crsWGS84"
             # swathList.polarisation = "%s" %  polarisation
-            swathList[:] = swathLayer
+
+            def writeSwathList(target, polarisation=polarisation):
+                target(swathList)[:] = self.getSwathList(polarisation)[0]
+            tasks.append(writeSwathList)
             break
 
+        print(f'\nComputing calibration, noise and subswath layers with {workers} worker(s)')
+        utils.run_writer_tasks(tasks, workers)
+
         # Add GCP information
         ##########################################################
         # Status
@@ -517,15 +643,7 @@ class Sentinel1_reader_and_NetCDF_converter:
         ncout.netcdf4_version_id = netCDF4.__netcdf4libversion__
         ncout.file_creation_date = nowstr
 
-        self.globalAttribs['Conventions'] = "CF-1.6"
-        self.globalAttribs['summary'] = 'Sentinel-1 C-band SAR GRD product.'
-        self.globalAttribs[
-            'keywords'] = '[Earth Science, Spectral/Engineering, RADAR, RADAR backscatter], ' \
-                          '[Earth Science, Spectral/Engineering, RADAR, RADAR imagery], ' \
-                          '[Earth Science, Spectral/Engineering, Microwave, Microwave Imagery]'
-        self.globalAttribs['keywords_vocabulary'] = "GCMD Science Keywords"
-        self.globalAttribs['institution'] = "Norwegian Meteorological Institute"
-        self.globalAttribs['history'] = nowstr + ". Converted from SAFE to NetCDF by NBS team."
+        self.globalAttribs.update(metadata.conversion_attributes(self.product_id, nowstr))
 
         ncout.setncatts(self.globalAttribs)
         ncout.sync()
@@ -539,6 +657,177 @@ class Sentinel1_reader_and_NetCDF_converter:
 
         return out_netcdf.is_file()
 
+    def writeCalibrationLayers(self, polarisation, targets, tile_rows):
+        """ Write the calibration layers of a polarisation, all LUTs being
+            interpolated together tile_rows rows at a time.
+
+            Keyword arguments:
+            polarisation -- polarisation
+            targets -- (time, y, x) NetCDF variables or arrays, one for each
+                       LUT of the polarisation, in xmlCalLUTs order
+            tile_rows -- number of rows interpolated at once
+        """
+        pixels, lines = self.xmlCalPixelLines[polarisation]
+        interpolator = self.getCalInterpolator(pixels, lines)
+        cal_tables = [self.xmlCalLUTs[c] for c in self.xmlCalLUTs
+                      if c.split('_')[-1] == polarisation]
+        for first_row in range(0, self.ySize, tile_rows):
+            last_row = min(first_row + tile_rows, self.ySize)
+            resampled_calibrations = interpolator(cal_tables, first_row, last_row)
+            for target, resampled_calibration in zip(targets, resampled_calibrations):
+                target[0, first_row:last_row, :] = resampled_calibration
+        return True
+
+    def writeSparseCalibration(self, ncout, polarisation, compression_level):
+        """ Write the calibration LUTs of a polarisation on their native
+            pixel/line grid.
+
+            Keyword arguments:
+            ncout -- NetCDF output file (open)
+            polarisation -- polarisation
+            compression_level -- compression level on output NetCDF file (1-9)
+        """
+        pixels, lines = self.xmlCalPixelLines[polarisation]
+        nb_pixels = (pixels == 0).sum()
+        nb_lines = (lines == 0).sum()
+        lineDim = str('calibration_line_' + polarisation)
+        pixelDim = str('calibration_pixel_' + polarisation)
+        ncout.createDimension(lineDim, nb_pixels)
+        ncout.createDimension(pixelDim, nb_lines)
+
+        var = ncout.createVariable(lineDim, 'i4', (lineDim,))
+        var.long_name = 'Image line of calibration vectors'
+        var.units = "1"
+        var[:] = lines[0::nb_lines]
+        var = ncout.createVariable(pixelDim, 'i4', (pixelDim,))
+        var.long_name = 'Image pixel of calibration vectors'
+        var.units = "1"
+        var[:] = pixels[0:nb_lines]
+
+        for calibration in self.xmlCalLUTs:
+            if calibration.split('_')[-1] != polarisation:
+                continue
+            var = ncout.createVariable(str(calibration), 'f4', ('time', lineDim, pixelDim),
+                                       zlib=True, complevel=compression_level)
+            var.long_name = '%s calibration table' % calibration
+            var.units = "1"
+            var.polarisation = "%s" % polarisation
+            var.comment = 'Calibration vectors at native resolution. Bicubic interpolation to ' \
+                          'the image grid gives the full resolution layer.'
+            var[0, :, :] = self.xmlCalLUTs[calibration].reshape(nb_pixels, nb_lines)
+
+    def writeSparseNoise(self, ncout, polarisation, compression_level):
+        """ Write the thermal noise range and azimuth vectors of a polarisation
+            with their line and pixel indices. The noise correction matrix
+            variable only holds the attributes needed to rebuild it.
+
+            Keyword arguments:
+            ncout -- NetCDF output file (open)
+            polarisation -- polarisation
+            compression_level -- compression level on output NetCDF file (1-9)
+        """
+        noiseVector = self.noiseVectors[polarisation]
+        imageAnnotation = self.imageAnnotation[polarisation]
+        t0 = datetime.strptime(imageAnnotation['productFirstLineUtcTime'], '%Y-%m-%dT%H:%M:%S.%f')
+        time_units = 'microseconds since %s' % t0.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+        def microseconds(t):
+            return (datetime.strptime(t, '%Y-%m-%dT%H:%M:%S.%f') - t0) // timedelta(
+                microseconds=1)
+
+        def padded(vectors, dtype, fill):
+            out = np.full((len(vectors), max(len(v) for v in vectors)), fill, dtype)
+            for i, v in enumerate(vectors):
+                out[i, :len(v)] = v
+            return out
+
+        def createVariable(name, dtype, dims, fill_value=None):
+            return ncout.createVariable(str(name + '_' + polarisation), dtype,
+                                        tuple(str(d + '_' + polarisation) for d in dims),
+                                        fill_value=fill_value, zlib=True,
+                                        complevel=compression_level)
+
+        # Noise in range direction
+        keys = sorted(noiseVector['range'].keys())
+        records = [noiseVector['range'][key] for key in keys]
+        ncout.createDimension(str('noise_range_record_' + polarisation), len(keys))
+        pixels = [np.array(r[1].split(), np.int32) for r in records]
+        ncout.createDimension(str('noise_range_sample_' + polarisation),
+                              max(len(p) for p in pixels))
+
+        var = createVariable('noise_range_time', 'i8', ('noise_range_record',))
+        var.long_name = 'Zero Doppler azimuth time of noise range vectors'
+        var.units = time_units
+        var[:] = [microseconds(key) for key in keys]
+        var = createVariable('noise_range_line', 'i4', ('noise_range_record',))
+        var.long_name = 'Image line of noise range vectors'
+        var.units = "1"
+        var[:] = [int(r[0]) for r in records]
+        var = createVariable('noise_range_pixel', 'i4',
+                             ('noise_range_record', 'noise_range_sample'), fill_value=-1)
+        var.long_name = 'Image pixel of noise range vectors'
+        var.units = "1"
+        var[:] = padded(pixels, np.int32, -1)
+        var = createVariable('noiseRangeLut', 'f8', ('noise_range_record', 'noise_range_sample'),
+                             fill_value=netCDF4.default_fillvals['f8'])
+        var.long_name = 'Thermal noise range vector power values'
+        var.units = "1"
+        var.coordinates = str('noise_range_line_' + polarisation + ' noise_range_pixel_' +
+                              polarisation)
+        var[:] = padded([np.array(r[2].split(), float) for r in records], float,
+                        netCDF4.default_fillvals['f8'])
+
+        # Noise in azimuth direction, or swath bounds for the old convention
+        old_convention = 'swathBounds' in noiseVector
+        blocks = noiseVector['swathBounds' if old_convention else 'azimuth']
+        blocks = [(swath, values) for block in blocks.values() for swath, values in block.items()]
+        swaths = sorted(set(swath for swath, values in blocks))
+        ncout.createDimension(str('noise_azimuth_block_' + polarisation), len(blocks))
+
+        var = createVariable('noise_azimuth_swath', 'i1', ('noise_azimuth_block',))
+        var.long_name = 'Subswath of noise azimuth blocks'
+        var.flag_values = np.arange(1, len(swaths) + 1, dtype=np.int8)
+        var.flag_meanings = ' '.join(swaths)
+        var[:] = [swaths.index(swath) + 1 for swath, values in blocks]
+        bounds = ['first_line', 'first_sample', 'last_line', 'last_sample']
+        for i, bound in enumerate(bounds):
+            var = createVariable('noise_azimuth_' + bound, 'i4', ('noise_azimuth_block',))
+            var.long_name = 'Image %s of noise azimuth blocks' % bound.replace('_', ' ')
+            var.units = "1"
+            var[:] = [int(values[i]) for swath, values in blocks]
+
+        if old_convention:
+            var = createVariable('noise_azimuth_time', 'i8', ('noise_azimuth_block',))
+            var.long_name = 'Zero Doppler azimuth time of swath bounds'
+            var.units = time_units
+            var[:] = [microseconds(values[4]) for swath, values in blocks]
+        else:
+            lines = [np.array(values[4].split(), np.int32) for swath, values in blocks]
+            ncout.createDimension(str('noise_azimuth_sample_' + polarisation),
+                                  max(len(l) for l in lines))
+            var = createVariable('noise_azimuth_line', 'i4',
+                                 ('noise_azimuth_block', 'noise_azimuth_sample'), fill_value=-1)
+            var.long_name = 'Image line of noise azimuth vectors'
+            var.units = "1"
+            var[:] = padded(lines, np.int32, -1)
+            var = createVariable('noiseAzimuthLut', 'f8',
+                                 ('noise_azimuth_block', 'noise_azimuth_sample'),
+                                 fill_value=netCDF4.default_fillvals['f8'])
+            var.long_name = 'Thermal noise azimuth vector power values'
+            var.units = "1"
+            var.coordinates = str('noise_azimuth_line_' + polarisation)
+            var[:] = padded([np.array(values[5].split(), float) for swath, values in blocks],
+                            float, netCDF4.default_fillvals['f8'])
+
+        var = ncout.createVariable(str('noiseCorrectionMatrix_' + polarisation), 'i1')
+        var.long_name = 'Thermal noise correction vector power values.'
+        var.polarisation = "%s" % polarisation
+        var.convention = 'swathBounds' if old_convention else 'azimuth'
+        var.productFirstLineUtcTime = imageAnnotation['productFirstLineUtcTime']
+        var.azimuthTimeInterval = imageAnnotation['azimuthTimeInterval']
+        var.comment = 'Noise vectors stored at native resolution, in the noise_range_* and ' \
+                      'noise_azimuth_* variables.'
+
     def readNoiseData(self, xmlfile):
         """ Method for reading noise data from Sentinel-1 annotation files.
             This method supports both the thermal noise denoising conventions
@@ -575,7 +864,7 @@ class Sentinel1_reader_and_NetCDF_converter:
                 values: noiseRangeVectorList, noiseAzimuthVectorList
         """
 
-        root = utils.xml_read(xmlfile)
+        root = self.annotations.get(xmlfile)
         polarisation = root.find('.//polarisation').text
 
         # Noise in range direction
@@ -603,7 +892,7 @@ class Sentinel1_reader_and_NetCDF_converter:
                          'radarFrequency', 'linesPerBurst',
                          'azimuthTimeInterval', 'productFirstLineUtcTime']
         for LAD in self.xmlFiles['s1Level1ProductSchema']:
-            lad_root = utils.xml_read(LAD)
+            lad_root = self.annotations.get(LAD)
             lad_polarisation = lad_root.find('.//polarisation').text
             if lad_polarisation == polarisation:
                 for lad_var in LAD_variables:
@@ -662,7 +951,7 @@ class Sentinel1_reader_and_NetCDF_converter:
 
     def readPixelsLines(self, xmlfile):
 
-        root = utils.xml_read(xmlfile)
+        root = self.annotations.get(xmlfile)
         polarisation = root.find('.//polarisation').text
 
         # Get pixels where we have calibration values. Assume regular distripution over all image
@@ -692,52 +981,53 @@ class Sentinel1_reader_and_NetCDF_converter:
 
         return (polarisation, pixels, lines)
 
-    def getCalTable(self, xmlfile, tName):
-        root = utils.xml_read(xmlfile)
+    def getCalTables(self, xmlfile, tNames):
+        """ Method for retrieving calibration tables from xml file, in one pass
+            over the file. Returns dictionary with table names as keys."""
+        root = self.annotations.get(xmlfile)
 
         # Get calibration values
-        cal = []
-        for c in root.iter(tName):
-            c = c.text.split(' ')
-            [cal.append(x) for x in c]
+        cal = {tName: [] for tName in tNames}
+        for c in root.iter(*tNames):
+            cal[c.tag].extend(c.text.split(' '))
 
         return cal
 
+    def getCalInterpolator(self, pixels, lines):
+        """ Returns the calibration interpolator of a pixel/line grid, shared
+            by all LUTs and polarisations on that grid."""
+        key = (pixels.tobytes(), lines.tobytes())
+        if key not in self.calInterpolators:
+            self.calInterpolators[key] = CalibrationInterpolator(pixels, lines, self.xSize,
+                                                                 self.ySize)
+        return self.calInterpolators[key]
+
     def getCalLayer(self, pixels, lines, cal_table):
         """ Interpolate calibration layer"""
-        xSize = self.xSize
-        ySize = self.ySize
+        return self.getCalInterpolator(pixels, lines)([cal_table])[0]
 
-        nb_pixels = (pixels == 0).sum()
-        nb_lines = (lines == 0).sum()
-        calibration_table = cal_table.reshape(nb_pixels, nb_lines)
-        tck = interpolate.RectBivariateSpline(lines[0::nb_lines], pixels[0:nb_lines],
-                                              calibration_table)
-        x = list(range(0, xSize))
-        y = list(range(0, ySize))
-        lutOut = tck(y, x)
-        return lutOut
-
-    def getGCPValues(self, xmlfile, parameter):
-        """ Method for retrieving Geo Location Point parameter from xml file."""
-        root = utils.xml_read(xmlfile)
+    def getGCPValues(self, xmlfile, parameters):
+        """ Method for retrieving Geo Location Point parameters from xml file,
+            in one pass over the grid points. Returns dictionary with parameters
+            as keys."""
+        root = self.annotations.get(xmlfile)
         polarisation = root.find('.//polarisation').text
 
         #
-        out_list = []
+        out_lists = {parameter: [] for parameter in parameters}
 
         # Get parameter values in ground control points
         for l in root.iter('geolocationGridPoint'):
-            out_list.append(l.find(parameter).text)
+            for parameter in parameters:
+                out_lists[parameter].append(l.find(parameter).text)
 
-        return polarisation, out_list
+        return polarisation, out_lists
 
-    def genLatLon_regGrid(self):
-        """ Method providing latitude and longitude arrays """
+    def getLatLonSplines(self):
+        """ Method providing latitude and longitude splines fitted on the GCP
+            grid """
         # Extract GCPs to vector arrays
         gcps = self.gcps
-        xsize = self.xSize
-        ysize = self.ySize
         ngcp = len(gcps)
         # print ngcp
         x = []
@@ -758,20 +1048,38 @@ class Sentinel1_reader_and_NetCDF_converter:
         lat = np.array(lat, np.float32)
         lon = np.array(lon, np.float32)
 
-        xi = list(range(0, xsize))
-        yi = list(range(0, ysize))
-        tck = interpolate.RectBivariateSpline(y, x, lat.reshape(len(y), len(x)))
-        latitude = tck(yi, xi)
-        tck = interpolate.RectBivariateSpline(y, x, lon.reshape(len(y), len(x)))
-        longitude = tck(yi, xi)
-
-        del lat
-        del lon
-        del tck
+        tck_lat = interpolate.RectBivariateSpline(y, x, lat.reshape(len(y), len(x)))
+        tck_lon = interpolate.RectBivariateSpline(y, x, lon.reshape(len(y), len(x)))
+        return tck_lat, tck_lon
 
+    def genLatLon_regGrid(self):
+        """ Method providing latitude and longitude arrays """
+        tck_lat, tck_lon = self.getLatLonSplines()
+        xi = list(range(0, self.xSize))
+        yi = list(range(0, self.ySize))
+        latitude = tck_lat(yi, xi)
+        longitude = tck_lon(yi, xi)
         return latitude, longitude
 
-    def readSwathList(self, noiseVector):  # ,imageAnnotationDict):
+    def writeLatLon_regGrid(self, nclat, nclon):
+        """ Method writing latitude and longitude to the output variables, one
+            row of chunks at a time. Peak memory is bounded by the chunk row
+            instead of the scene.
+
+            Keyword arguments:
+            nclat, nclon -- chunked (y, x) NetCDF variables
+        """
+        tck_lat, tck_lon = self.getLatLonSplines()
+        tile_rows = nclat.chunking()[0]
+        xi = np.arange(self.xSize)
+        for first_row in range(0, self.ySize, tile_rows):
+            yi = np.arange(first_row, min(first_row + tile_rows, self.ySize))
+            nclat[yi[0]:yi[-1] + 1, :] = tck_lat(yi, xi)
+            nclon[yi[0]:yi[-1] + 1, :] = tck_lon(yi, xi)
+        return True
+
+    @staticmethod
+    def readSwathList(noiseVector):  # ,imageAnnotationDict):
         """ Returns dictionary with swath ID as key and number of azimuth denoising
             blocks as value.
 
@@ -794,6 +1102,16 @@ class Sentinel1_reader_and_NetCDF_converter:
         swathList = dict(list(zip(swathList, swathListCounts)))
         return swathList
 
+    def getSwathFlags(self):
+        """ Returns the subswath flags of the product mode, or None for an
+            undefined mode."""
+        if self.globalAttribs['MODE'] == 'EW':
+            return {'EW1': 1, 'EW2': 2, 'EW3': 3, 'EW4': 4, 'EW5': 5}
+        elif self.globalAttribs['MODE'] == 'IW':
+            return {'IW1': 1, 'IW2': 2, 'IW3': 3}
+        print("Undefined mode %s" % self.globalAttribs['MODE'])
+        return None
+
     def getSwathList(self, polarisation):
         """ Returns swathList as raster layer.
 
@@ -804,15 +1122,11 @@ class Sentinel1_reader_and_NetCDF_converter:
 
         swathMergeList = self.productMetadataList[polarisation]['swathMergeList']
 
-        if self.globalAttribs['MODE'] == 'EW':
-            subswath_flag = {'EW1': 1, 'EW2': 2, 'EW3': 3, 'EW4': 4, 'EW5': 5}
-        elif self.globalAttribs['MODE'] == 'IW':
-            subswath_flag = {'IW1': 1, 'IW2': 2, 'IW3': 3}
-        else:
-            print("Undefined mode %s" % self.globalAttribs['MODE'])
+        subswath_flag = self.getSwathFlags()
+        if not subswath_flag:
             return 0
 
-        swathListRaster = np.zeros((self.ySize, self.xSize))
+        swathListRaster = np.zeros((self.ySize, self.xSize), np.int8)
         for index, subswath in swathMergeList.items():
             for key, value in subswath.items():
                 firstAzimuthLine, firstRangeSample, lastAzimuthLine, lastRangeSample, azimuthTime\
@@ -826,57 +1140,77 @@ class Sentinel1_reader_and_NetCDF_converter:
 
         return swathListRaster, subswath_flag
 
-    def getNoiseRangeRecordsInInterval(self, noiseRangeVectors, noiseAzimuthVectorStart,
+    @staticmethod
+    def getNoiseRangeIndex(noiseRangeVectorList):
+        """ Returns the noise range records of a polarisation sorted by time,
+            with times as a numpy datetime64 array and pre-parsed line, pixel
+            and LUT arrays. Each record is parsed once.
+
+            Keyword values:
+
+            noiseRangeVectorList -- noise range records, as from readNoiseData
+        """
+        keys = list(noiseRangeVectorList.keys())
+        times = np.array(keys, dtype='datetime64[us]')
+        order = np.argsort(times, kind='mergesort')
+        records = [noiseRangeVectorList[keys[i]] for i in order]
+        return {'times': times[order],
+                'lines': np.array([int(record[0]) for record in records]),
+                'pixels': [np.array(record[1].split(), int) for record in records],
+                'luts': [np.array(record[2].split(), float) for record in records]}
+
+    @staticmethod
+    def getNoiseRangeRecordsInInterval(noiseRangeIndex, noiseAzimuthVectorStart,
                                        noiseAzimuthVectorStop):
         """ Method for the retrieval of the noise Range records in the current
             azimuth denoising block, according to the:
             'Thermal Denoising of Products Generated by the S-1 IPF.'
 
+            Returns the first and last (excluded) index of the records in the
+            block, found by binary search.
+
             Keyword values:
 
-            noiseRangeVectors -- list of timestamps for all noise range vectors
+            noiseRangeIndex -- noise range records, from getNoiseRangeIndex
             noiseAzimuthVectorStart -- start time for azimuth block
             noiseAzimuthVectorStop -- stop time for azimuth block
         """
-        validNoiseRangeVectors = []
-        first_index = None
-        for index, vector in enumerate(noiseRangeVectors):
-            vector_time = datetime.strptime(vector, '%Y-%m-%dT%H:%M:%S.%f')
+        times = noiseRangeIndex['times']
+        first_index = np.searchsorted(times, np.datetime64(noiseAzimuthVectorStart, 'us'), 'left')
+        stop_index = np.searchsorted(times, np.datetime64(noiseAzimuthVectorStop, 'us'), 'right')
+        return first_index, max(first_index, stop_index)
 
-            if noiseAzimuthVectorStart <= vector_time <= noiseAzimuthVectorStop:
-                validNoiseRangeVectors.append(vector)
-                if not first_index:
-                    first_index = index
-
-        return validNoiseRangeVectors, first_index
-
-    def getNearestRangeRecordInInterval(self, noiseRangeKeys, blockCenterTime,
+    @classmethod
+    def getNearestRangeRecordInInterval(cls, noiseRangeIndex, blockCenterTime,
                                         currentSwathStartTime, currentSwathEndTime):
-        """ Returns the key for the noise range record in the current
+        """ Returns the index of the noise range record in the current
             swath closest to the center of the azimuth block, according to the:
             'Thermal Denoising of Products Generated by the S-1 IPF.'
+            Returns None if the swath has no record.
 
             Keyword values:
 
-            noiseRangeKeys -- datestamps for noise range records
+            noiseRangeIndex -- noise range records, from getNoiseRangeIndex
             blockCenterTime -- center of the noise azimuth block
             currentSwathStartTime -- start time for the current sub-swath
             currentSwathEndTime -- end time for the current sub-swath
         """
-
-        valid_vectors, index = self.getNoiseRangeRecordsInInterval(noiseRangeKeys,
-                                                                   currentSwathStartTime,
-                                                                   currentSwathEndTime)
-        valid_vectors_dt = [datetime.strptime(vector, '%Y-%m-%dT%H:%M:%S.%f') for vector in
-                            valid_vectors]
-
-        nearest_record = [min(valid_vectors_dt, key=lambda x: abs(x - blockCenterTime)).strftime(
-            "%Y-%m-%dT%H:%M:%S.%f")]
-        index = valid_vectors.index(nearest_record[0])
-        return nearest_record, index
+        first_index, stop_index = cls.getNoiseRangeRecordsInInterval(
+            noiseRangeIndex, currentSwathStartTime, currentSwathEndTime)
+        if first_index == stop_index:
+            return None
+
+        times = noiseRangeIndex['times']
+        center = np.datetime64(blockCenterTime, 'us')
+        # Nearest record is on either side of the center, the earliest one on ties
+        after = min(max(np.searchsorted(times, center), first_index), stop_index - 1)
+        before = max(after - 1, first_index)
+        if abs(times[before] - center) <= abs(times[after] - center):
+            return before
+        return after
 
     def getNoiseCorrectionMatrix(self, noiseAzimuthAndRangeVectorList, polarisation):
-        """ Returns the thermal noise correction matrix according to the:
+        """ Returns the thermal noise correction matrix (float32) according to the:
             'Thermal Denoising of Products Generated by the S-1 IPF.'
 
             Keyword values:
@@ -887,8 +1221,63 @@ class Sentinel1_reader_and_NetCDF_converter:
 
             polarisation -- polarisation
         """
+        noiseCorrectionMatrix_ = np.zeros((self.ySize, self.xSize), np.float32)
+        self.writeNoiseCorrectionMatrix(noiseAzimuthAndRangeVectorList, polarisation,
+                                        noiseCorrectionMatrix_)
+        return noiseCorrectionMatrix_
+
+    def writeNoiseCorrectionMatrix(self, noiseAzimuthAndRangeVectorList, polarisation, target,
+                                   tile_lines=1024):
+        """ Writes the thermal noise correction matrix of a polarisation of
+            the product, see computeNoiseCorrectionMatrix.
+
+            Keyword values:
+
+            noiseAzimuthAndRangeVectorList -- defaultdict with range and
+            azimuth/swathBounds as keys, depending on old or new denoising
+            format.
+
+            polarisation -- polarisation
+
+            target -- NetCDF variable or array, indexed on its last two
+            (y, x) dimensions
+
+            tile_lines -- maximum number of lines computed at once
+        """
+        return self.computeNoiseCorrectionMatrix(noiseAzimuthAndRangeVectorList,
+                                                 self.imageAnnotation[polarisation], self.xSize,
+                                                 self.ySize, target, tile_lines)
+
+    @classmethod
+    def computeNoiseCorrectionMatrix(cls, noiseAzimuthAndRangeVectorList, imageAnnotation, xSize,
+                                     ySize, target, tile_lines=1024):
+        """ Writes the thermal noise correction matrix according to the:
+            'Thermal Denoising of Products Generated by the S-1 IPF.'
+
+            The matrix is computed one azimuth block and swath at a time (at
+            most tile_lines lines at a time), as the product of range and
+            azimuth noise, and written to target as float32. Pixels outside
+            all blocks are set to 0. No full scene array is allocated.
+            Only depends on its arguments, so that it can be called without
+            SAFE product, e.g. from a NetCDF file written with sparse_luts.
+
+            Keyword values:
+
+            noiseAzimuthAndRangeVectorList -- defaultdict with range and
+            azimuth/swathBounds as keys, depending on old or new denoising
+            format.
+
+            imageAnnotation -- image annotation of the polarisation, with
+            productFirstLineUtcTime and azimuthTimeInterval
+
+            xSize, ySize -- image size
+
+            target -- NetCDF variable or array, indexed on its last two
+            (y, x) dimensions
+
+            tile_lines -- maximum number of lines computed at once
+        """
         t0_duration = datetime.now()
-        imageAnnotation = self.imageAnnotation[polarisation]
 
         old_convention = False
         if 'swathBounds' in noiseAzimuthAndRangeVectorList:  # old NADS
@@ -897,13 +1286,12 @@ class Sentinel1_reader_and_NetCDF_converter:
         else:
             noiseAzimuthVectorList = noiseAzimuthAndRangeVectorList['azimuth']
 
-        noiseRangeVectorList = noiseAzimuthAndRangeVectorList['range']
+        noiseRangeIndex = cls.getNoiseRangeIndex(noiseAzimuthAndRangeVectorList['range'])
 
-        swathList = self.readSwathList(noiseAzimuthAndRangeVectorList)
+        swathList = cls.readSwathList(noiseAzimuthAndRangeVectorList)
         t0 = datetime.strptime(imageAnnotation['productFirstLineUtcTime'], '%Y-%m-%dT%H:%M:%S.%f')
         delta_ts = float(imageAnnotation['azimuthTimeInterval'])  # [s]
-        noiseAzimuthMatrix = np.zeros((self.ySize, self.xSize))
-        noiseRangeMatrix = np.zeros((self.ySize, self.xSize))
+        windows = []  # (firstAzimuthLine, lastAzimuthLine, firstRangeSample, lastRangeSample)
 
         # Deciding current swath time interval
         for swath_, swathCount_ in swathList.items():
@@ -950,8 +1338,8 @@ class Sentinel1_reader_and_NetCDF_converter:
                     numberOfLines = lastAzimuthLine - firstAzimuthLine + 1
 
                     if not old_convention:
-                        line = np.array(values[4].split(), np.int)
-                        noiseAzimuthLUT = np.array(values[5].split(), np.float)
+                        line = np.array(values[4].split(), int)
+                        noiseAzimuthLUT = np.array(values[5].split(), float)
                         # print noiseAzimuthVector_id,lineIndex,line, noiseAzimuthLUT
                         if len(line) > 1:
                             intp1 = interpolate.interp1d(line, noiseAzimuthLUT,
@@ -974,42 +1362,35 @@ class Sentinel1_reader_and_NetCDF_converter:
                         # noiseAzimuthVector_,(numberOfSamples,1))
                         # noiseAzimuthMatrix[firstAzimuthLine:lastAzimuthLine+1,
                         # firstRangeSample:lastRangeSample+1]=noiseAzimuthVector_
-                        noiseAzimuthMatrix[firstAzimuthLine:lastAzimuthLine + 1,
-                        firstRangeSample:lastRangeSample + 1] = np.tile(noiseAzimuthVector_,
-                                                                        (numberOfSamples, 1)).T
                     else:
-                        noiseAzimuthMatrix[:] = 1
+                        noiseAzimuthVector_ = np.ones(1)
 
                     # STEP 2
                     # Parsing the range denoising record
-                    noiseRangeKeys = sorted(noiseRangeVectorList.keys())  # NOTE Is this OK?
-                    validRangeVectorKeys, noiseRangeVectorFirstIndex = \
-                        self.getNoiseRangeRecordsInInterval(
-                        noiseRangeKeys, noiseAzimuthVectorStart, noiseAzimuthVectorStop)
-                    if len(validRangeVectorKeys) == 0:
+                    noiseRangeVectorFirstIndex, noiseRangeVectorStopIndex = \
+                        cls.getNoiseRangeRecordsInInterval(
+                        noiseRangeIndex, noiseAzimuthVectorStart, noiseAzimuthVectorStop)
+                    if noiseRangeVectorFirstIndex == noiseRangeVectorStopIndex:
                         blockCenterTime = noiseAzimuthVectorStart + (
                                     noiseAzimuthVectorStop - noiseAzimuthVectorStart) / 2
-                        validRangeVectorKeys, noiseRangeVectorFirstIndex = \
-                            self.getNearestRangeRecordInInterval(
-                            noiseRangeKeys,
+                        noiseRangeVectorFirstIndex = cls.getNearestRangeRecordInInterval(
+                            noiseRangeIndex,
                             blockCenterTime, currentSwathStartTime,
                             currentSwathEndTime)
-                        if validRangeVectorKeys == None:
+                        if noiseRangeVectorFirstIndex is None:
                             print('Error. No valid vector found.')
                             sys.exit([1])
+                        noiseRangeVectorStopIndex = noiseRangeVectorFirstIndex + 1
+                    validRangeRecords = range(noiseRangeVectorFirstIndex, noiseRangeVectorStopIndex)
 
-                    noiseRangeVectorList_ = np.zeros((numberOfSamples, len(validRangeVectorKeys)))
+                    noiseRangeVectorList_ = np.zeros((numberOfSamples, len(validRangeRecords)))
                     # noiseRangeVectorLine_ = np.zeros((numberOfSamples,
                     # len(validRangeVectorKeys))) #should be numberOfLines?
-                    noiseRangeVectorLine_ = np.zeros((len(validRangeVectorKeys)))
-
-                    # print validRangeVectorKeys, noiseRangeVectorFirstIndex
-                    for index, key in enumerate(validRangeVectorKeys):
-                        rangeRecordIndex = index + noiseRangeVectorFirstIndex
-                        rangeRecPixels_ = np.array(noiseRangeVectorList[key][1].split(),
-                                                   np.int)  # getNoiseRangeRecordByIndex (
-                        # rangeRecordIndex)
-                        rangeRecLines_ = np.array(noiseRangeVectorList[key][2].split(), np.float)
+                    noiseRangeVectorLine_ = np.zeros((len(validRangeRecords)))
+
+                    for index, rangeRecordIndex in enumerate(validRangeRecords):
+                        rangeRecPixels_ = noiseRangeIndex['pixels'][rangeRecordIndex]
+                        rangeRecLines_ = noiseRangeIndex['luts'][rangeRecordIndex]
                         rangePixelToInterp_0 = np.argwhere(
                             rangeRecPixels_ >= firstRangeSample).min()
                         rangePixelToInterp_n = np.argwhere(rangeRecPixels_ <= lastRangeSample).max()
@@ -1025,28 +1406,165 @@ class Sentinel1_reader_and_NetCDF_converter:
                                                            fill_value='extrapolate')
                         noiseRangeVectorList_[:, index] = intp1_range(sampleIndex)
 
-                        noiseRangeVectorLine_[index] = np.int(noiseRangeVectorList[key][0])
+                        noiseRangeVectorLine_[index] = noiseRangeIndex['lines'][rangeRecordIndex]
 
                     # STEP 3
-                    # Generate range/azimuth denoising correction
-                    noiseRangeMatrix_ = np.zeros((numberOfSamples, numberOfLines))
-
-                    for i in range(numberOfSamples):
-                        if len(noiseRangeVectorLine_) > 1:
-                            intp1_line = interpolate.interp1d(noiseRangeVectorLine_,
-                                                              noiseRangeVectorList_[i, :],
-                                                              fill_value='extrapolate')
-                            noiseRangeMatrix_[i, :] = intp1_line(lineIndex)
-                        else:
-                            noiseRangeMatrix_[i, :] = noiseRangeVectorList_[
-                                i]  # Not able to perform azimuth interpolation. Hence writing the same value to each line index.
+                    # Generate range/azimuth denoising correction, by tiles of lines
+                    if len(noiseAzimuthVector_) == 1:
+                        noiseAzimuthVector_ = np.repeat(noiseAzimuthVector_, numberOfLines)
+                    tiles = np.arange(firstAzimuthLine // tile_lines + 1,
+                                      lastAzimuthLine // tile_lines + 1) * tile_lines
+                    for tile in np.split(np.arange(numberOfLines), tiles - firstAzimuthLine):
+                        noiseRangeMatrix_ = cls.interpolateNoiseRangeBlock(
+                            noiseRangeVectorLine_, noiseRangeVectorList_, lineIndex[tile])
+                        noiseCorrectionMatrix_ = noiseRangeMatrix_ * noiseAzimuthVector_[tile][
+                                                                     :, np.newaxis]
+                        target[..., lineIndex[tile[0]]:lineIndex[tile[-1]] + 1,
+                               sampleIndex[0]:sampleIndex[-1] + 1] = \
+                            noiseCorrectionMatrix_.astype(np.float32)
+                    windows.append((firstAzimuthLine, lastAzimuthLine, firstRangeSample,
+                                    lastRangeSample))
+
+        # Pixels outside all blocks
+        for firstLine, lastLine, firstSample, lastSample in cls.getUncoveredWindows(windows, xSize,
+                                                                                    ySize):
+            target[..., firstLine:lastLine + 1, firstSample:lastSample + 1] = np.zeros(
+                (lastLine - firstLine + 1, lastSample - firstSample + 1), np.float32)
 
-                    noiseRangeMatrix[lineIndex[0]:lineIndex[-1] + 1,
-                    sampleIndex[0]:sampleIndex[-1] + 1] = noiseRangeMatrix_.T
-
-        noiseCorrectionMatrix_ = noiseRangeMatrix * noiseAzimuthMatrix
         print("Created noise correction matrix in: ", datetime.now() - t0_duration)
-        return noiseCorrectionMatrix_
+        return True
+
+    @staticmethod
+    def getUncoveredWindows(windows, xSize, ySize):
+        """ Returns the (firstLine, lastLine, firstSample, lastSample) windows
+            of the image covered by none of the input windows.
+
+            Keyword values:
+
+            windows -- list of (firstLine, lastLine, firstSample, lastSample)
+            xSize, ySize -- image size
+        """
+        uncovered = []
+        breaks = {0, ySize}
+        for firstLine, lastLine, firstSample, lastSample in windows:
+            breaks.update([min(max(firstLine, 0), ySize),
+                           min(max(lastLine + 1, 0), ySize)])
+        breaks = sorted(breaks)
+        # Within each band of lines between breaks, the covering windows are the same
+        for bandStart, bandStop in zip(breaks[:-1], breaks[1:]):
+            covering = sorted((firstSample, lastSample) for firstLine, lastLine, firstSample,
+                              lastSample in windows if firstLine <= bandStart and
+                              lastLine >= bandStop - 1)
+            sample = 0
+            for firstSample, lastSample in covering:
+                if firstSample > sample:
+                    uncovered.append((bandStart, bandStop - 1, sample, firstSample - 1))
+                sample = max(sample, lastSample + 1)
+            if sample < xSize:
+                uncovered.append((bandStart, bandStop - 1, sample, xSize - 1))
+        return uncovered
+
+    @staticmethod
+    def interpolateNoiseRangeBlock(noiseRangeVectorLine, noiseRangeVectorList, lineIndex):
+        """ Returns the range noise of one azimuth block linearly interpolated
+            (and extrapolated) in azimuth direction, as a (lines, samples) array.
+
+            All range samples of the block are interpolated at once. Lines
+            falling between the same two noise range records share the same
+            slope, which is computed once per record interval as an array over
+            all samples. The arithmetic is the one of scipy's interp1d, so
+            values are identical to interpolating each sample separately.
+
+            Keyword values:
+
+            noiseRangeVectorLine -- line of each valid noise range record
+            noiseRangeVectorList -- (samples, records) range noise of the block
+            lineIndex -- increasing lines of the azimuth block
+        """
+        if len(noiseRangeVectorLine) < 2:
+            # Not able to perform azimuth interpolation. Hence writing the same value to each
+            # line index.
+            return np.repeat(noiseRangeVectorList[:, 0][np.newaxis, :], len(lineIndex), axis=0)
+
+        order = np.argsort(noiseRangeVectorLine, kind='mergesort')
+        recordLines = np.asarray(noiseRangeVectorLine, float)[order]
+        recordValues = noiseRangeVectorList.T[order]
+
+        # Record interval used for each line, the first and last ones being extrapolated
+        intervals = np.searchsorted(recordLines, lineIndex).clip(1, len(recordLines) - 1)
+        bounds = np.searchsorted(intervals, np.arange(1, len(recordLines) + 1))
+
+        noiseRangeMatrix_ = np.empty((len(lineIndex), noiseRangeVectorList.shape[0]))
+        for hi in range(1, len(recordLines)):
+            start, stop = bounds[hi - 1], bounds[hi]
+            if start == stop:
+                continue
+            lo = hi - 1
+            slope = (recordValues[hi] - recordValues[lo]) / (recordLines[hi] - recordLines[lo])
+            noiseRangeMatrix_[start:stop] = slope * (lineIndex[start:stop] - recordLines[lo])[:,
+                                                    np.newaxis] + recordValues[lo]
+        return noiseRangeMatrix_
+
+
+def rebuild_full_grid(ncfile, name):
+    """ Rebuild a full resolution calibration or noise correction layer from
+        a NetCDF file written with sparse_luts=True.
+
+        Keyword arguments:
+        ncfile -- NetCDF file (already open)
+        name -- variable name, e.g. sigmaNought_VV or noiseCorrectionMatrix_VV
+
+        Returns (y, x) array
+    """
+    polarisation = name.split('_')[-1]
+    xSize = len(ncfile.dimensions['x'])
+    ySize = len(ncfile.dimensions['y'])
+
+    def values(variable):
+        return ncfile[str(variable + '_' + polarisation)][:]
+
+    if not name.startswith('noiseCorrectionMatrix'):
+        lines = np.asarray(values('calibration_line'))
+        pixels = np.asarray(values('calibration_pixel'))
+        interpolator = CalibrationInterpolator(np.tile(pixels, len(lines)),
+                                               np.repeat(lines, len(pixels)), xSize, ySize)
+        return interpolator([ncfile[name][0].filled().ravel()])[0]
+
+    # Noise vectors back to the readNoiseData structure
+    attributes = ncfile[name]
+    t0 = datetime.strptime(attributes.productFirstLineUtcTime, '%Y-%m-%dT%H:%M:%S.%f')
+
+    def time_string(microseconds):
+        return (t0 + timedelta(microseconds=int(microseconds))).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+    def text(vector):
+        return ' '.join(repr(v) for v in vector.compressed().tolist())
+
+    noiseRangeVectorList = {}
+    for time, line, pixels, lut in zip(values('noise_range_time'), values('noise_range_line'),
+                                       values('noise_range_pixel'), values('noiseRangeLut')):
+        noiseRangeVectorList[time_string(time)] = [str(line), text(pixels), text(lut)]
+
+    swathVariable = ncfile[str('noise_azimuth_swath_' + polarisation)]
+    swaths = swathVariable.flag_meanings.split()
+    bounds = [values('noise_azimuth_' + b) for b in ['first_line', 'first_sample', 'last_line',
+                                                     'last_sample']]
+    if attributes.convention == 'swathBounds':
+        extra = [[time_string(t)] for t in values('noise_azimuth_time')]
+    else:
+        extra = [[text(line), text(lut)] for line, lut in zip(values('noise_azimuth_line'),
+                                                             values('noiseAzimuthLut'))]
+    blocks = defaultdict(dict)
+    for i, swath in enumerate(swathVariable[:]):
+        blocks[i][swaths[swath - 1]] = [str(b[i]) for b in bounds] + extra[i]
+    noiseVector = {'range': noiseRangeVectorList, attributes.convention: blocks}
+
+    imageAnnotation = {'productFirstLineUtcTime': attributes.productFirstLineUtcTime,
+                       'azimuthTimeInterval': attributes.azimuthTimeInterval}
+    noiseCorrectionMatrix = np.zeros((ySize, xSize), np.float32)
+    Sentinel1_reader_and_NetCDF_converter.computeNoiseCorrectionMatrix(
+        noiseVector, imageAnnotation, xSize, ySize, noiseCorrectionMatrix)
+    return noiseCorrectionMatrix
 
 
 if __name__ == '__main__':
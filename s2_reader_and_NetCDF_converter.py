@@ -30,10 +30,16 @@ import scipy.ndimage
 from osgeo import gdal
 import safe_to_netcdf.utils as utils
 import safe_to_netcdf.constants as cst
+import safe_to_netcdf.metadata as metadata
 import os
+import threading
 gdal.UseExceptions()
 
 
+# pyproj transformers, per thread
+_transformers = threading.local()
+
+
 class Sentinel2_reader_and_NetCDF_converter:
     ''' Class for reading Sentinel-2 MSI L1C/L2A products from SAFE with methods for
         reading auxilary information as e.g. clouds, solar and view angles.
@@ -45,32 +51,61 @@ class Sentinel2_reader_and_NetCDF_converter:
         Keyword arguments:
         SAFE_file -- absolute path to zipped file
         SAFE_outpath -- output storage location for unzipped SAFE product
+        extract -- True to extract the whole product, 'needed' to extract only the files
+                   used by the converter, False to read it in place from the zip file
+        cache -- utils.SafeCache where the product is extracted instead of SAFE_outpath,
+                 shared with other processes. Cannot be used with extract=False
+        lazy -- do not read the product when created: each group of attributes (e.g. GCPs,
+                calibration tables, angles) is read when first used
         '''
 
-    def __init__(self, product, indir, outdir):
+    # Attributes loaded on first access by lazy readers, and their loaders
+    mainXML = utils.LazyAttribute('loadProduct')
+    dterrengdata = utils.LazyAttribute('loadProduct')
+    xmlFiles = utils.LazyAttribute('loadProduct')
+    imageFiles = utils.LazyAttribute('loadProduct')
+    globalAttribs = utils.LazyAttribute('loadProduct')
+    src = utils.LazyAttribute('loadProduct')
+    image_list_dterreng = utils.LazyAttribute('loadProduct')
+    sunAndViewAngles = utils.LazyAttribute('loadAngles')
+    angleSteps = utils.LazyAttribute('loadAngles')
+    SAFE_structure = utils.LazyAttribute('loadStructure')
+
+    def __init__(self, product, indir, outdir, extract=True, cache=None, lazy=False):
         self.product_id = product
         self.input_zip = (indir / product).with_suffix('.zip')
         self.SAFE_dir = (outdir / self.product_id).with_suffix('.SAFE')
+        self.extract = extract
+        self.cache = cache
+        self.archive = None  # utils.SafeArchive when reading the zip file in place
+        self.extracted = False  # SAFE_dir extracted by this reader, removed by clean
         self.processing_level = 'Level-' + self.product_id.split('_')[1][4:6]
-        self.xmlFiles = defaultdict(list)
-        self.imageFiles = defaultdict(list)
-        self.globalAttribs = {}
-        self.src = None
         self.t0 = datetime.now()
         self.ncout = None  # NetCDF output file
         self.reference_band = None
-        self.dterrengdata = False  # variable saying if products is Norwegian DEM L1C
-        self.sunAndViewAngles = defaultdict(list)
         self.vectorInformation = defaultdict(list)
-        self.SAFE_structure = None
-        self.image_list_dterreng = []
-
-        self.main()
+        self.lock = threading.RLock()  # held while loading attributes
+        self.loaded = set()
+        self.loading = set()
+        if not lazy:
+            self.main()
 
     def main(self):
         """ Main method for traversing and reading key values from SAFE
             directory.
         """
+        utils.load(self, 'loadProduct')
+        utils.load(self, 'loadAngles')
+        utils.load(self, 'loadStructure')
+
+    def loadProduct(self):
+        """ Uncompress the SAFE product and read the main file and global attributes """
+        self.xmlFiles = defaultdict(list)
+        self.imageFiles = defaultdict(list)
+        self.globalAttribs = {}
+        self.src = None
+        self.dterrengdata = False  # variable saying if products is Norwegian DEM L1C
+        self.image_list_dterreng = []
 
         # 1) unzip SAFE archive
         utils.uncompress(self)
@@ -78,7 +113,10 @@ class Sentinel2_reader_and_NetCDF_converter:
         # 2) Set some of the global __init__ variables
         utils.initializer(self)
 
-        # 3) Read sun and view angles
+    def loadAngles(self):
+        """ Read sun and view angles """
+        self.sunAndViewAngles = defaultdict(list)
+        self.angleSteps = {}  # distance between angle grid points along y and x
         print('\nRead view and sun angles')
         if not self.dterrengdata:
             currXml = self.xmlFiles['S2_{}_Tile1_Metadata'.format(self.processing_level)]
@@ -86,18 +124,35 @@ class Sentinel2_reader_and_NetCDF_converter:
             currXml = self.xmlFiles['MTD_TL']
         self.readSunAndViewAngles(currXml)
 
-        # 5) Retrieve SAFE product structure
+    def loadStructure(self):
+        """ Retrieve SAFE product structure """
         # much difficulty afterwards to be able to save this to netCDF
         ##self.SAFE_structure = zipfile.ZipFile(self.input_zip).namelist()
         self.SAFE_structure = self.list_product_structure()
 
-    def write_to_NetCDF(self, nc_outpath, compression_level, chunk_size=(1, 32, 32)):
+    def write_to_NetCDF(self, nc_outpath, compression_level, chunk_size=(1, 32, 32),
+                        stream_angles=False, angles_on_tie_points=False,
+                        native_resolution=False, workers=1, latlon_cache=None,
+                        pack_masks=False):
         """ Method writing output NetCDF product.
 
         Keyword arguments:
         nc_outpath -- output path where NetCDF file should be stored
         compression_level -- compression level on output NetCDF file (1-9)
         chunk_size -- chunk_size
+        stream_angles -- write the upsampled sun and view angles window by window, without
+                         allocating the full resolution grids
+        angles_on_tie_points -- store the sun and view angles on their native grid, with CF-1.9
+                                coordinate subsampling metadata, instead of upsampling them
+        native_resolution -- keep 20m and 60m bands and L2A layers at their native resolution,
+                             on x_20m / y_20m and x_60m / y_60m, instead of upsampling them
+        workers -- number of threads decoding bands at the same time, each using its share
+                   of the GDAL JPEG2000 decoding threads, and computing lat/lon tiles.
+                   Also number of processes rasterizing the GML masks.
+        latlon_cache -- utils.FileCache of lat/lon files, reused by all products on the same
+                        grid instead of computing and compressing lat/lon again
+        pack_masks -- pack the per band defective, no data, saturated and technical quality
+                      masks into one bitfield variable per mask type
         """
 
         print("------------START CONVERSION FROM SAFE TO NETCDF-------------")
@@ -123,25 +178,27 @@ class Sentinel2_reader_and_NetCDF_converter:
         # output filename
         out_netcdf = (nc_outpath / self.product_id).with_suffix('.nc')
 
-        with (netCDF4.Dataset(out_netcdf, 'w', format='NETCDF4')) as ncout:
-            ncout.createDimension('time', 1)
-            ncout.createDimension('x', nx)
-            ncout.createDimension('y', ny)
+        # Start from the cached lat/lon of this grid, if any
+        latlon_file = latlon_cache is not None
+        if latlon_file:
+            key = latlon_cache.key('lat_lon', self.reference_band.GetGeoTransform(),
+                                   self.reference_band.GetProjection(), nx, ny,
+                                   compression_level, tuple(chunk_size[1:]))
+            latlon_cache.copy(key, out_netcdf, lambda path: self.writeLatLonFile(
+                path, nx, ny, compression_level, chunk_size, workers))
+            print(f'Lat/lon cache: {latlon_cache}')
+
+        with (netCDF4.Dataset(out_netcdf, 'a' if latlon_file else 'w',
+                              format='NETCDF4')) as ncout:
+            if not latlon_file:
+                ncout.createDimension('time', 1)
+                ncout.createDimension('x', nx)
+                ncout.createDimension('y', ny)
 
             utils.create_time(ncout, self.globalAttribs["PRODUCT_START_TIME"])
 
-            nclat = ncout.createVariable('lat','f4',('y','x',),zlib=True,complevel=compression_level, chunksizes=chunk_size[1:])
-            nclon = ncout.createVariable('lon','f4',('y','x',),zlib=True,complevel=compression_level, chunksizes=chunk_size[1:])
-            lat,lon = self.genLatLon(nx,ny) #Assume gcps are on a regular grid
-            nclat.long_name = 'latitude'
-            nclat.units = 'degrees_north'
-            nclat.standard_name = 'latitude'
-            nclat[:,:]=lat
-
-            nclon.long_name = 'longitude'
-            nclon.units = 'degrees_east'
-            nclon.standard_name = 'longitude'
-            nclon[:,:]=lon
+            if not latlon_file:
+                self.addLatLon(ncout, nx, ny, compression_level, chunk_size, workers)
 
             # Add projection coordinates
             ##########################################################
@@ -174,9 +231,11 @@ class Sentinel2_reader_and_NetCDF_converter:
             if self.dterrengdata:
                 # For DTERR data, gdal fails to properly do the src.GetSubDatasets()
                 # so manually read the list of images created beforehand
-                images = [[str(i), i.stem] for i in self.image_list_dterreng]
+                images = [[utils.gdal_path(self, i), i.stem] for i in self.image_list_dterreng]
             else:
                 images = self.src.GetSubDatasets()
+            # Bands are decoded by tasks, run once all variables are defined
+            tasks = []
             for k, v in images:
                 subdataset = gdal.Open(k)
                 subdataset_geotransform = subdataset.GetGeoTransform()
@@ -193,9 +252,8 @@ class Sentinel2_reader_and_NetCDF_converter:
                     varout.long_name = 'TCI RGB from B4, B3 and B2'
                     varout._Unsigned = "true"
                     for i in range(1, subdataset.RasterCount + 1):
-                        current_band = subdataset.GetRasterBand(i)
-                        band_measurement = current_band.GetVirtualMemArray()
-                        varout[i - 1, :, :] = band_measurement
+                        tasks.append(lambda target, k=k, i=i, varout=varout:
+                                     self.decodeBand(k, i, target(varout), (i - 1,), workers))
                 # Reflectance data for each band
                 else:
                     for i in range(1, subdataset.RasterCount + 1):
@@ -206,12 +264,17 @@ class Sentinel2_reader_and_NetCDF_converter:
                         else:
                             band_metadata = current_band.GetMetadata()
                             varName = band_metadata['BANDNAME']
+                        if native_resolution:
+                            dims = ('time',) + self.addResolutionGrid(ncout, subdataset)
+                        else:
+                            dims = ('time', 'y', 'x')
                         varout = ncout.createVariable(varName, np.uint16,
-                                                      ('time', 'y', 'x'), fill_value=0,
+                                                      dims, fill_value=0,
                                                       zlib=True, complevel=compression_level,
                                                       chunksizes=chunk_size)
                         varout.units = "1"
-                        varout.coordinates = "lat lon" ;
+                        if dims[1:] == ('y', 'x'):
+                            varout.coordinates = "lat lon"
                         varout.grid_mapping = "UTM_projection"
                         if self.processing_level == 'Level-2A':
                             varout.standard_name = 'surface_bidirectional_reflectance'
@@ -228,15 +291,15 @@ class Sentinel2_reader_and_NetCDF_converter:
                         varout._Unsigned = "true"
                         # from DN to reflectance
                         print((varName, subdataset_geotransform))
-                        if subdataset_geotransform[1] != 10:
-                            current_size = current_band.XSize
-                            band_measurement = scipy.ndimage.zoom(
-                                input=current_band.GetVirtualMemArray(), zoom=nx / current_size,
-                                order=0)
+                        if subdataset_geotransform[1] == 10 or native_resolution:
+                            zoom = 1
                         else:
-                            band_measurement = current_band.GetVirtualMemArray()
-                        #print(band_measurement.shape)
-                        varout[0, :, :] = band_measurement
+                            zoom = nx / current_band.XSize
+                        tasks.append(lambda target, k=k, i=i, varout=varout, zoom=zoom:
+                                     self.decodeBand(k, i, target(varout), (0,), workers, zoom))
+
+            print(f'\nDecoding {len(tasks)} bands with {workers} worker(s)')
+            utils.run_writer_tasks(tasks, workers)
 
             # set grid mapping
             ##########################################################
@@ -260,29 +323,57 @@ class Sentinel2_reader_and_NetCDF_converter:
             print('\nAdding vector layers')
             utils.memory_use(self.t0)
 
-            for gmlfile in self.xmlFiles.values():
-                if gmlfile and gmlfile.suffix == '.gml':
-                    layer = gmlfile.stem
-                    rasterized_ok, layer_mask, mask = self.rasterizeVectorLayers(nx, ny, gmlfile)
-                    # build transformer, assuming matching coordinate systems.
+            # Masks are rasterized in a process pool and written in order as they come back
+            gmlfiles = [gmlfile for gmlfile in self.xmlFiles.values()
+                        if gmlfile and gmlfile.suffix == '.gml']
+            if pack_masks:
+                # Group masks packed together, so that one bitfield is built at a time
+                gmlfiles.sort(key=lambda gmlfile: self.getPackedMaskType(gmlfile.stem) or '')
+            packed = None  # (name, bitfield) being built
+            geotransform = self.reference_band.GetGeoTransform()
+            rasterized = utils.map_in_processes(
+                rasterize_vector_layer,
+                [(nx, ny, utils.gdal_path(self, gmlfile), geotransform) for gmlfile in gmlfiles],
+                workers)
+            for gmlfile, (rasterized_ok, layer_mask, mask) in zip(gmlfiles, rasterized):
+                layer = gmlfile.stem
+                packed_name = self.getPackedMaskType(layer) if pack_masks else None
+                if packed is not None and packed[0] != packed_name:
+                    self.writePackedMask(ncout, *packed, chunk_size)
+                    packed = None
+                if packed_name:
+                    if packed is None:
+                        packed = (packed_name, np.zeros((ny, nx), dtype=np.uint16))
                     if rasterized_ok:
-                        if layer == "MSK_CLOUDS_B00":
-                            layer_name = 'Clouds'
-                            comment_name = 'cloud'
-                        else:
-                            layer_name = layer
-                            comment_name = 'vector'
-                        varout = ncout.createVariable(layer_name, 'i1', ('time', 'y', 'x'),
-                                                          fill_value=-1, zlib=True,
-                                                          chunksizes=chunk_size)
-                        varout.long_name = f"{layer_name} mask 10m resolution"
-                        varout.comment = f"Rasterized {comment_name} information."
-                        varout.coordinates = "lat lon"
-                        varout.grid_mapping = "UTM_projection"
-                        varout.flag_values = np.array(list(layer_mask.values()), dtype=np.int8)
-                        varout.flag_meanings = ' '.join(
-                            [key.replace('-', '_') for key in list(layer_mask.keys())])
-                        varout[0, :] = mask
+                        bit = list(cst.s2_bands_aliases).index(layer.split('_')[2])
+                        packed[1][mask > 0] |= np.uint16(1 << bit)
+                    continue
+                # build transformer, assuming matching coordinate systems.
+                if rasterized_ok:
+                    if layer == "MSK_CLOUDS_B00":
+                        layer_name = 'Clouds'
+                        comment_name = 'cloud'
+                    else:
+                        layer_name = layer
+                        comment_name = 'vector'
+                    varout = ncout.createVariable(layer_name, 'i1', ('time', 'y', 'x'),
+                                                      fill_value=-1, zlib=True,
+                                                      chunksizes=chunk_size)
+                    varout.long_name = f"{layer_name} mask 10m resolution"
+                    varout.comment = f"Rasterized {comment_name} information."
+                    varout.coordinates = "lat lon"
+                    varout.grid_mapping = "UTM_projection"
+                    varout.flag_values = np.array(list(layer_mask.values()), dtype=np.int8)
+                    varout.flag_meanings = ' '.join(
+                        [key.replace('-', '_') for key in list(layer_mask.keys())])
+                    varout[0, :] = mask
+            if packed is not None:
+                self.writePackedMask(ncout, *packed, chunk_size)
+
+            # Raster masks, replacing GML masks from processing baseline 04.00 onward
+            for mask_file in self.getRasterMasks():
+                print(f'\tCopying raster mask {mask_file.name}')
+                self.addRasterMask(ncout, mask_file, nx, chunk_size, native_resolution)
 
             # Add Level-2A layers
             ##########################################################
@@ -300,10 +391,12 @@ class Sentinel2_reader_and_NetCDF_converter:
                             print((layer, v, k))
                             l2a_kv[k] = cst.s2_l2a_layers[layer]
 
+                tasks = []
                 for k, v in list(l2a_kv.items()):
                     print((k, v))
                     varName, longName = v.split(',')
-                    SourceDS = gdal.Open(self.SAFE_path + self.imageFiles[k], gdal.GA_ReadOnly)
+                    layer_path = self.SAFE_path + self.imageFiles[k]
+                    SourceDS = gdal.Open(layer_path, gdal.GA_ReadOnly)
                     if SourceDS.RasterCount > 1:
                         print("Raster data contains more than one layer")
                     NDV = SourceDS.GetRasterBand(1).GetNoDataValue()
@@ -314,8 +407,12 @@ class Sentinel2_reader_and_NetCDF_converter:
                         gdal.GetDataTypeName(SourceDS.GetRasterBand(1).DataType)]
                     # print(NDV, xsize, ysize, GeoT, DataType)
 
+                    if native_resolution:
+                        dims = ('time',) + self.addResolutionGrid(ncout, SourceDS)
+                    else:
+                        dims = ('time', 'y', 'x')
                     varout = ncout.createVariable(varName, DataType,
-                                                  ('time', 'y', 'x'), fill_value=0, zlib=True,
+                                                  dims, fill_value=0, zlib=True,
                                                   complevel=compression_level,
                                                   chunksizes=chunk_size)
                     # varout.coordinates = "lat lon" ;
@@ -328,12 +425,14 @@ class Sentinel2_reader_and_NetCDF_converter:
                         varout.flag_meanings = ' '.join(
                             [key for key in list(cst.s2_scene_classification_flags.keys())])
 
-                    if GeoT[1] != 10:
-                        raster_data = scipy.ndimage.zoom(input=SourceDS.GetVirtualMemArray(),
-                                                         zoom=nx / xsize, order=0)
+                    if GeoT[1] == 10 or native_resolution:
+                        zoom = 1
                     else:
-                        raster_data = SourceDS.GetVirtualMemArray()
-                    varout[0, :] = raster_data
+                        zoom = nx / xsize
+                    tasks.append(lambda target, layer_path=layer_path, varout=varout, zoom=zoom:
+                                 self.decodeBand(layer_path, 1, target(varout), (0,), workers,
+                                                 zoom))
+                utils.run_writer_tasks(tasks, workers)
 
             # Add sun and view angles
             ##########################################################
@@ -341,27 +440,33 @@ class Sentinel2_reader_and_NetCDF_converter:
             print('\nAdding sun and view angles')
             utils.memory_use(self.t0)
 
-            counter = 1
-            for k, v in list(self.sunAndViewAngles.items()):
-                print(("\tHandeling %i of %i" % (counter, len(self.sunAndViewAngles))))
-                angle_step = int(math.ceil(nx / float(v.shape[0])))
-
-                resampled_angles = self.resample_angles(v, nx, v.shape[0], v.shape[1], angle_step,
-                                                        type=np.float32)
-
-                varout = ncout.createVariable(k, np.float32, ('time', 'y', 'x'),
-                                              fill_value=netCDF4.default_fillvals['f4'], zlib=True,
-                                              chunksizes=chunk_size)
-                varout.units = 'degree'
-                if 'sun' in k:
-                    varout.long_name = 'Solar %s angle' % k.split('_')[-1]
-                else:
-                    varout.long_name = 'Viewing incidence %s angle' % k.split('_')[1]
-                varout.coordinates = 'lat lon'
-                varout.grid_mapping = "UTM_projection"
-                varout.comment = '1 to 1 with original 22x22 resolution'
-                varout[0, :, :] = resampled_angles
-                counter += 1
+            if angles_on_tie_points:
+                self.writeTiePointAngles(ncout, xnp, ynp, compression_level)
+            else:
+                counter = 1
+                for k, v in list(self.sunAndViewAngles.items()):
+                    print(("\tHandeling %i of %i" % (counter, len(self.sunAndViewAngles))))
+                    v = v[:-1, :-1]  # without the grid points past the image edge
+                    angle_step = int(math.ceil(nx / float(v.shape[0])))
+
+                    varout = ncout.createVariable(k, np.float32, ('time', 'y', 'x'),
+                                                  fill_value=netCDF4.default_fillvals['f4'],
+                                                  zlib=True, chunksizes=chunk_size)
+                    varout.units = 'degree'
+                    if 'sun' in k:
+                        varout.long_name = 'Solar %s angle' % k.split('_')[-1]
+                    else:
+                        varout.long_name = 'Viewing incidence %s angle' % k.split('_')[1]
+                    varout.coordinates = 'lat lon'
+                    varout.grid_mapping = "UTM_projection"
+                    varout.comment = '1 to 1 with original 22x22 resolution'
+                    if stream_angles:
+                        self.resample_angles(v, nx, v.shape[0], v.shape[1], angle_step,
+                                             type=np.float32, target=varout)
+                    else:
+                        varout[0, :, :] = self.resample_angles(v, nx, v.shape[0], v.shape[1],
+                                                               angle_step, type=np.float32)
+                    counter += 1
 
             # Add xml files as character values see:
             # https://stackoverflow.com/questions/37079883/string-handling-in-python-netcdf4
@@ -407,17 +512,10 @@ class Sentinel2_reader_and_NetCDF_converter:
             ncout.netcdf4_version_id = netCDF4.__netcdf4libversion__
             ncout.file_creation_date = nowstr
 
-            self.globalAttribs['Conventions'] = "CF-1.6"
-            self.globalAttribs[
-                'summary'] = 'Sentinel-2 Multi-Spectral Instrument {} product.'.format(
-                self.processing_level)
-            self.globalAttribs[
-                'keywords'] = '[Earth Science, Atmosphere, Atmospheric radiation, Reflectance]'
-            self.globalAttribs['keywords_vocabulary'] = "GCMD Science Keywords"
-            self.globalAttribs['institution'] = "Norwegian Meteorological Institute"
-            self.globalAttribs['history'] = nowstr + ". Converted from SAFE to NetCDF by NBS team."
-            self.globalAttribs['source'] = "surface observation"
-            root = utils.xml_read(self.mainXML)
+            self.globalAttribs.update(metadata.conversion_attributes(self.product_id, nowstr))
+            if angles_on_tie_points:
+                self.globalAttribs['Conventions'] = "CF-1.9"
+            root = utils.xml_read(self.mainXML, self.archive)
             if not self.dterrengdata:
                 self.globalAttribs['orbitNumber'] = root.find('.//safe:orbitNumber',
                                                               namespaces=root.nsmap).text
@@ -440,16 +538,20 @@ class Sentinel2_reader_and_NetCDF_converter:
         """ Method for reading XML files returning the entire file as single
             string.
         """
-        if not xmlfile.is_file():
+        if not utils.is_file(self, xmlfile):
             print(('Error: Can\'t find xmlfile %s' % (xmlfile)))
             return False
         try:
             parser = ET.XMLParser(recover=True)
-            tree = ET.parse(str(xmlfile), parser)
+            if self.archive is not None:
+                with self.archive.open(xmlfile) as infile:
+                    tree = ET.parse(infile, parser)
+            else:
+                tree = ET.parse(str(xmlfile), parser)
             return ET.tostring(tree)
         except:
             print(("Could not parse %s as xmlFile. Try to open regularly." % xmlfile))
-            with open(xmlfile, 'r') as infile:
+            with utils.open_text(self, xmlfile) as infile:
                 text = infile.read()
             if text:
                 return text
@@ -462,134 +564,364 @@ class Sentinel2_reader_and_NetCDF_converter:
             annotation files.
         """
 
-        root = utils.xml_read(xmlfile)
+        root = utils.xml_read(xmlfile, self.archive)
 
-        angles_view_list = root.findall('.//Tile_Angles')[0]
-        angle_step = float(root.findall('.//COL_STEP')[0].text)  # m
-        col_step = float(root.findall('.//ROW_STEP')[0].text)  # m
+        angles_view_list = root.find('.//Tile_Angles')
+        angle_step = float(angles_view_list.find('.//COL_STEP').text)  # m
+        self.angleSteps = {'y': float(angles_view_list.find('.//ROW_STEP').text),
+                           'x': angle_step}  # m
         nx = int(root.xpath(str(
             '//n1:{}_Tile_ID/n1:Geometric_Info/Tile_Geocoding/Size[@resolution=10]/NROWS'.format(
                 self.processing_level)), namespaces=root.nsmap)[0].text)  # nb of rows
-        ny = int(root.xpath(str(
-            '//n1:{}_Tile_ID/n1:Geometric_Info/Tile_Geocoding/Size[@resolution=10]/NCOLS'.format(
-                self.processing_level)), namespaces=root.nsmap)[0].text)  # nb of columns
         spatial_resolution = 10
 
-        angle_len = int(math.ceil(nx * spatial_resolution / angle_step))
-        sun_zenith = np.zeros((angle_len, angle_len), dtype=np.float32)
-        sun_azimuth = np.zeros((angle_len, angle_len), dtype=np.float32)
-        angle_step = int(math.ceil(nx / float(angle_len)))
-        incidence_angles_list = angles_view_list.findall('Viewing_Incidence_Angles_Grids')
+        # Grid points, the last ones past the image edge
+        angle_len = int(math.ceil(nx * spatial_resolution / angle_step)) + 1
 
         # Sun angles
+        sun_zenith = np.zeros((angle_len, angle_len), dtype=np.float32)
+        sun_azimuth = np.zeros((angle_len, angle_len), dtype=np.float32)
         for angle in angles_view_list.find('Sun_Angles_Grid'):
-            # print('\t',angle.tag)
-            counter_entry = 0
-            values_list = angle.find('Values_List')
-            for value_entry in values_list[0:-1]:
-                if angle.tag == 'Zenith':
-                    tmp_sun = np.array([float(i) for i in value_entry.text.split()])[0:-1]
-                    sun_zenith[counter_entry, :] = tmp_sun
-                    counter_entry += 1
-                if angle.tag == 'Azimuth':
-                    tmp_sun = np.array([float(i) for i in value_entry.text.split()])[0:-1]
-                    sun_azimuth[counter_entry, :] = tmp_sun
-                    counter_entry += 1
+            if angle.tag == 'Zenith':
+                sun_zenith = self.readValuesList(angle.find('Values_List'), angle_len)
+            if angle.tag == 'Azimuth':
+                sun_azimuth = self.readValuesList(angle.find('Values_List'), angle_len)
 
         self.sunAndViewAngles['sun_zenith'] = sun_zenith
         self.sunAndViewAngles['sun_azimuth'] = sun_azimuth
 
-        # View angles
-        counter_angle = 0
-        for BANDID in np.array(list(cst.s2_bands_order.keys())):
-            tmp_view_zenith = np.zeros((angle_len, angle_len), dtype=np.float32)
-            tmp_view_azimuth = np.zeros((angle_len, angle_len), dtype=np.float32)
-            tmp_view_zenith[:] = np.nan
-            tmp_view_azimuth[:] = np.nan
-            for incidence_angles in incidence_angles_list:
-                if int(incidence_angles.attrib['bandId']) == BANDID:
-                    # print('\t',incidence_angles.attrib)
-                    for angle in incidence_angles:
-                        values_list = angle.find('Values_List')
-                        counter_entry = 0
-                        for value_entry in values_list[0:-1]:
-                            if angle.tag == 'Zenith':
-                                tmp_angle = np.array([float(i) for i in value_entry.text.split()])[
-                                            0:-1]
-                                tmp_view_zenith[counter_entry, np.isnan(tmp_angle) == False] = \
-                                tmp_angle[np.isnan(tmp_angle) == False]
-                                counter_entry += 1
-                            if angle.tag == 'Azimuth':
-                                tmp_angle = np.array([float(i) for i in value_entry.text.split()])[
-                                            0:-1]
-                                tmp_view_azimuth[counter_entry, np.isnan(tmp_angle) == False] = \
-                                tmp_angle[np.isnan(tmp_angle) == False]
-                                counter_entry += 1
-                    counter_angle += 1
-                self.sunAndViewAngles[
-                    str('view_zenith_' + cst.s2_bands_order[BANDID])] = tmp_view_zenith
-                self.sunAndViewAngles[
-                    str('view_azimuth_' + cst.s2_bands_order[BANDID])] = tmp_view_azimuth
-
-    def resample_angles(self, angles, new_dim, angles_length, angles_height, step, type=np.float32):
+        # View angles, one grid per band and detector
+        detector_grids = defaultdict(lambda: defaultdict(list))
+        for incidence_angles in angles_view_list.iterfind('Viewing_Incidence_Angles_Grids'):
+            bandId = int(incidence_angles.attrib['bandId'])
+            for angle in incidence_angles:
+                if angle.tag in ['Zenith', 'Azimuth']:
+                    detector_grids[bandId][angle.tag].append(
+                        self.readValuesList(angle.find('Values_List'), angle_len, np.nan))
+        if not detector_grids:
+            return
+
+        # Merge detectors: the valid value of the last detector covering each grid point
+        for BANDID in list(cst.s2_bands_order.keys()):
+            for tag in ['Zenith', 'Azimuth']:
+                merged = np.full((angle_len, angle_len), np.nan, dtype=np.float32)
+                if detector_grids[BANDID][tag]:
+                    grids = np.stack(detector_grids[BANDID][tag])
+                    valid = ~np.isnan(grids)
+                    last = len(grids) - 1 - np.argmax(valid[::-1], axis=0)
+                    merged = np.take_along_axis(grids, last[np.newaxis], axis=0)[0]
+                self.sunAndViewAngles[str('view_' + tag.lower() + '_' +
+                                          cst.s2_bands_order[BANDID])] = merged
+
+    def readValuesList(self, values_list, angle_len, fill_value=0):
+        """ Method converting a Values_List element of an angle grid to a numpy array.
+
+        Keyword arguments:
+        values_list -- Values_List element
+        angle_len -- size of the output (square) array
+        fill_value -- value of the output array where the grid has no values
+        """
+        rows = [value_entry.text for value_entry in values_list]
+        values = np.array(' '.join(rows).split(), dtype=np.float64).reshape(len(rows), -1)
+        angles = np.full((angle_len, angle_len), fill_value, dtype=np.float32)
+        angles[:len(rows), :values.shape[1]] = values
+        return angles
+
+    def angleTiePoints(self, nodes, step, size):
+        """ Method mapping the grid points of one axis of the angle grids to output pixels.
+            Grid points past the last pixel are replaced by a single tie point on the last pixel,
+            interpolated linearly between the grid points on each side of it.
+            Returns the pixel index of each tie point, and the two grid points and weight of the
+            second one giving its value.
+
+        Keyword arguments:
+        nodes -- number of grid points along the axis
+        step -- distance between grid points, in pixels
+        size -- number of pixels along the axis
+        """
+        positions = np.arange(nodes) * step
+        inside = int(np.count_nonzero(positions <= size - 1))
+        indices = positions[:inside]
+        lower = np.arange(inside)
+        upper = np.arange(inside)
+        weights = np.zeros(inside)
+        if inside < nodes and indices[-1] < size - 1:
+            indices = np.append(indices, size - 1)
+            lower = np.append(lower, inside - 1)
+            upper = np.append(upper, inside)
+            weights = np.append(weights, (size - 1 - positions[inside - 1]) / step)
+        return np.round(indices).astype(np.int32), lower, upper, weights
+
+    def writeTiePointAngles(self, ncout, xnp, ynp, compression_level):
+        """ Method writing sun and view angles on their native grid.
+            The angle grid points are given as angle_y / angle_x coordinates, and mapped to the
+            full resolution y / x grid following CF-1.9 coordinate subsampling.
+
+        Keyword arguments:
+        ncout -- NetCDF output file (already open)
+        xnp, ynp -- projection coordinates of the full resolution grid
+        compression_level -- compression level on output NetCDF file (1-9)
+        """
+        nodes = dict(zip(['y', 'x'], next(iter(self.sunAndViewAngles.values())).shape))
+        coordinates = {'y': np.asarray(ynp), 'x': np.asarray(xnp)}
+        resolution = abs(float(xnp[1]) - float(xnp[0]))  # m
+        tie_points = {}
+
+        for dim in ['y', 'x']:
+            tie_dim = 'angle_%s' % dim
+            indices, lower, upper, weights = self.angleTiePoints(
+                nodes[dim], self.angleSteps[dim] / resolution, len(coordinates[dim]))
+            tie_points[dim] = (lower, upper, weights)
+            ncout.createDimension(tie_dim, len(indices))
+            nctie = ncout.createVariable(tie_dim, 'i4', tie_dim, zlib=True)
+            nctie.units = 'm'
+            nctie.standard_name = 'projection_%s_coordinate' % dim
+            nctie.long_name = '%s coordinate of sun and view angle tie points' % dim
+            nctie[:] = coordinates[dim][indices]
+            ncindex = ncout.createVariable('%s_index' % tie_dim, 'i4', tie_dim, zlib=True)
+            ncindex.long_name = 'index of sun and view angle tie points along %s' % dim
+            ncindex[:] = indices
+
+        ncinterp = ncout.createVariable('angle_interpolation', 'i4')
+        ncinterp.interpolation_name = 'bi_linear'
+        ncinterp.tie_point_mapping = 'y: angle_y_index angle_y x: angle_x_index angle_x'
+        ncinterp.computational_precision = '32'
+        ncinterp.long_name = 'mapping of sun and view angle tie points to the y / x grid'
+        ncout.Conventions = 'CF-1.9'
+
+        for k, v in list(self.sunAndViewAngles.items()):
+            # Values at the tie points, along y then x
+            for axis, dim in enumerate(['y', 'x']):
+                lower, upper, weights = tie_points[dim]
+                weights = np.expand_dims(weights, 1 - axis)
+                v = (np.take(v, lower, axis) * (1 - weights) +
+                     np.take(v, upper, axis) * weights)
+            varout = ncout.createVariable(k, np.float32, ('time', 'angle_y', 'angle_x'),
+                                          fill_value=netCDF4.default_fillvals['f4'], zlib=True,
+                                          complevel=compression_level)
+            varout.units = 'degree'
+            if 'sun' in k:
+                varout.long_name = 'Solar %s angle' % k.split('_')[-1]
+            else:
+                varout.long_name = 'Viewing incidence %s angle' % k.split('_')[1]
+            varout.coordinates = 'angle_y angle_x'
+            varout.coordinate_interpolation = 'y: x: angle_interpolation'
+            varout.grid_mapping = "UTM_projection"
+            varout.comment = 'Original %ix%i resolution, see angle_interpolation' % (
+                nodes['y'], nodes['x'])
+            varout[0, :, :] = v
+        return True
+
+    def resample_angles(self, angles, new_dim, angles_length, angles_height, step, type=np.float32,
+                        target=None, index=(0,)):
         ''' Resample angles to get 1-1 with original output.
+            Each angle is repeated over a step x step block, the last row and column of the
+            grid extending to the edge of the output.
             angles: numpy array
             new_dim: new dimension (one number, assumes quadratic)
             angles_length: nb. columns in angles array
             angles_height: nb. rows in angles array
             step: stepsize for new dimension
             type: numpy dtype. float32 default
+            target: if given, NetCDF variable the resampled angles are written into, window by
+                    window, instead of being returned as a full array
+            index: indices of target before (y, x)
             '''
-        angles_resampled = np.zeros((new_dim, new_dim), dtype=type)
-        for i in range(angles_length):
-            for j in range(angles_height):
-                if not i == angles_length - 1 and not j == angles_height - 1:
-                    angles_resampled[i * step:i * step + step, j * step:j * step + step] = angles[
-                        i, j]
-                else:
-                    angles_resampled[i * step:new_dim, j * step:new_dim] = angles[i, j]
-        return angles_resampled
+        # Angle grid cell of each output row / column
+        rows = np.minimum(np.arange(new_dim) // step, angles_length - 1)
+        cols = np.minimum(np.arange(new_dim) // step, angles_height - 1)
+        angles = angles.astype(type)
+        if target is None:
+            return angles.repeat(np.bincount(rows, minlength=angles_length), axis=0).repeat(
+                np.bincount(cols, minlength=angles_height), axis=1)
+
+        chunk_shape = (1, 1)
+        if target.chunking() != 'contiguous':
+            chunk_shape = tuple(target.chunking()[-2:])
+        for xoff, yoff, xcount, ycount in utils.copy_windows(new_dim, new_dim, chunk_shape):
+            window_cols = cols[xoff:xoff + xcount]
+            window = angles[rows[yoff:yoff + ycount], window_cols[0]:window_cols[-1] + 1]
+            target[tuple(index) + (slice(yoff, yoff + ycount), slice(xoff, xoff + xcount))] = \
+                window.repeat(np.bincount(window_cols - window_cols[0]), axis=1)
+        return True
 
     def rasterizeVectorLayers(self, nx, ny, gmlfile):
+        """ Method rasterizing a GML mask file on the reference band grid.
+            See rasterize_vector_layer.
+        """
+        return rasterize_vector_layer(nx, ny, gmlfile, self.reference_band.GetGeoTransform())
 
-        # Open the data source and read in the extent
-        NoData_value = 0
+    def getPackedMaskType(self, layer):
+        """ Method returning the name of the bitfield variable a per band mask is packed into
+            (e.g. MSK_SATURA for MSK_SATURA_B01), or None if the mask is not packed.
+        """
+        parts = layer.split('_')
+        if len(parts) == 3 and parts[1] in cst.s2_packed_mask_types and \
+                parts[2] in cst.s2_bands_aliases:
+            return '_'.join(parts[:2])
+        return None
 
-        source_ds = ogr.Open(str(gmlfile))
-        source_layer = source_ds.GetLayer()
-        # Check that gml file contains features
-        if source_layer is None:
-            return False, None, None
+    def writePackedMask(self, ncout, name, bitfield, chunk_size):
+        """ Method writing a bitfield variable holding the masks of all bands, one bit per band
+            in the order of cst.s2_bands_aliases.
 
-        geotransform = self.reference_band.GetGeoTransform()
-        dst_ds = gdal.GetDriverByName('MEM').Create('', nx, ny, 1, gdal.GDT_Byte)
-        dst_rb = dst_ds.GetRasterBand(1)
-        dst_rb.SetNoDataValue(NoData_value)
-        dst_ds.SetGeoTransform(geotransform)
-
-        flag_values = []
-        flag_meanings = []
-        for i in range(0, source_layer.GetFeatureCount()):
-            feat = source_layer.GetFeature(i)
-            name = feat.GetField('gml_id')
-            source_layer.SetAttributeFilter("gml_id = \'%s\'" % name)
-            if 'OPAQUE' in name:
-                value = int(name.split('.')[-1]) + 1
-            else:
-                value = int(name[-1]) + 1
-            gdal.RasterizeLayer(dst_ds, [1], source_layer, burn_values=[value])
-            flag_values.append(value)
-            flag_meanings.append(name)
+        Keyword arguments:
+        ncout -- NetCDF output file (already open)
+        name -- variable name
+        bitfield -- bitfield array
+        chunk_size -- chunk_size
+        """
+        bands = list(cst.s2_bands_aliases)
+        varout = ncout.createVariable(name, bitfield.dtype, ('time', 'y', 'x'),
+                                      fill_value=False, zlib=True, chunksizes=chunk_size)
+        varout.long_name = f"{name} masks of all bands 10m resolution"
+        varout.comment = "Rasterized vector information, one bit per band."
+        varout.coordinates = "lat lon"
+        varout.grid_mapping = "UTM_projection"
+        varout.flag_masks = np.array([1 << i for i in range(len(bands))], dtype=bitfield.dtype)
+        varout.flag_meanings = ' '.join(bands)
+        varout[0, :] = bitfield
+        return True
+
+    def getRasterMasks(self):
+        """ Method listing the JPEG2000 masks (MSK_QUALIT, MSK_CLASSI, MSK_DETFOO) of the
+            product, found in the image and xml files.
+        """
+        mask_types = list(cst.s2_raster_mask_bands) + ['MSK_DETFOO']
+        masks = set()
+        for files in [self.imageFiles, self.xmlFiles]:
+            for path in files.values():
+                if path and path.suffix == '.jp2' and \
+                        '_'.join(path.stem.split('_')[:2]) in mask_types:
+                    masks.add(path)
+        return sorted(masks)
+
+    def addRasterMask(self, ncout, mask_file, nx, chunk_size, native_resolution=False):
+        """ Method copying a JPEG2000 mask, window by window.
+            Detector footprints are copied as they are. Other masks have one boolean band per
+            flag, packed in one byte variable described with CF flag_masks.
 
-        dst_ds.FlushCache()
-        mask_arr = dst_ds.GetRasterBand(1).ReadAsArray()
-        dst_ds = None
+        Keyword arguments:
+        ncout -- NetCDF output file (already open)
+        mask_file -- JPEG2000 mask file
+        nx -- number of pixels of the 10m grid
+        chunk_size -- chunk_size
+        native_resolution -- keep the mask at its native resolution
+        """
+        layer = mask_file.stem
+        mask_type = '_'.join(layer.split('_')[:2])
+        dataset = gdal.Open(utils.gdal_path(self, mask_file))
+        if native_resolution:
+            dims = ('time',) + self.addResolutionGrid(ncout, dataset)
+            factor = 1
+        else:
+            dims = ('time', 'y', 'x')
+            factor = nx / dataset.RasterXSize
+
+        if mask_type == 'MSK_DETFOO':
+            varout = ncout.createVariable(layer, 'i1', dims, fill_value=-1, zlib=True,
+                                          chunksizes=chunk_size)
+            varout.comment = "Detector footprint, detector number."
+            self.copyUpsampled(dataset.GetRasterBand(1), varout, zoom=factor)
+        else:
+            flag_meanings = cst.s2_raster_mask_bands[mask_type][:dataset.RasterCount]
+            varout = ncout.createVariable(layer, 'u1', dims, fill_value=False, zlib=True,
+                                          chunksizes=chunk_size)
+            varout.comment = "One bit per band of the raster mask."
+            varout.flag_masks = np.array([1 << i for i in range(len(flag_meanings))],
+                                         dtype=np.uint8)
+            varout.flag_meanings = ' '.join(flag_meanings)
+            self.copyUpsampled(dataset, varout, zoom=factor, convert=self.packMaskBands)
+        varout.long_name = f"{layer} mask"
+        if dims[1:] == ('y', 'x'):
+            varout.coordinates = "lat lon"
+        varout.grid_mapping = "UTM_projection"
+        dataset = None
+        return True
+
+    def packMaskBands(self, data):
+        """ Method packing the bands of a mask window, (bands, y, x) or (y, x) for one band,
+            in a bitfield with bit i set where band i is not zero.
+        """
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        bitfield = np.zeros(data.shape[1:], dtype=np.uint8)
+        for i in range(len(data)):
+            bitfield[data[i] != 0] |= np.uint8(1 << i)
+        return bitfield
 
-        # order flags for easier comparison
-        sorted_pairs = sorted(zip(flag_meanings, flag_values))
-        layer_mask = dict(sorted_pairs)
+    def decodeBand(self, dataset_name, band_number, target, index=(0,), workers=1, zoom=1):
+        """ Method decoding a raster band into a NetCDF variable.
+            The dataset is opened here, so that bands can be decoded in worker threads.
 
-        return True, layer_mask, mask_arr
+        Keyword arguments:
+        dataset_name -- gdal dataset (or subdataset) name
+        band_number -- band number in the dataset
+        target -- NetCDF variable (or utils.QueuedTarget) to write into
+        index -- indices of target before (y, x)
+        workers -- number of bands decoded at the same time, sharing the GDAL threads
+        zoom -- upsampling factor to the output grid
+        """
+        if workers > 1:
+            gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS',
+                                            str(max(1, os.cpu_count() // workers)))
+        try:
+            dataset = gdal.Open(dataset_name)
+            band = dataset.GetRasterBand(band_number)
+            self.copyUpsampled(band, target, index, zoom)
+            band = None
+            dataset = None
+        finally:
+            if workers > 1:
+                gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+        return True
+
+    def copyUpsampled(self, source, target, index=(0,), zoom=1, convert=None):
+        """ Method copying a raster band (or all bands of a dataset) into a NetCDF variable,
+            upsampled to the output grid. Bands and masks go through here, so that masks
+            stay aligned with the bands they describe.
+
+        Keyword arguments:
+        source -- gdal band or dataset
+        target -- NetCDF variable (or utils.QueuedTarget) to write into
+        index -- indices of target before (y, x)
+        zoom -- upsampling factor to the output grid
+        convert -- function applied to the data read, before upsampling
+        """
+        if zoom == 1 or zoom == 2:
+            # Window by window. Block replication is the same as zoom with order=0 for 2
+            utils.copy_band(source, target, index=index, factor=int(zoom), convert=convert)
+        else:
+            data = source.ReadAsArray()
+            if convert is not None:
+                data = convert(data)
+            target[tuple(index) + (slice(None), slice(None))] = scipy.ndimage.zoom(
+                input=data, zoom=zoom, order=0)
+
+    def addResolutionGrid(self, ncout, dataset):
+        """ Method adding the dimensions and projection coordinates of the grid of a dataset
+            at its native resolution (e.g. x_20m / y_20m), if not already there.
+            Projection coordinates follow the same convention as x / y.
+
+        Keyword arguments:
+        ncout -- NetCDF output file (already open)
+        dataset -- gdal dataset
+
+        Returns: names of the (y, x) dimensions
+        """
+        ulx, xres, xskew, uly, yskew, yres = dataset.GetGeoTransform()
+        if xres == 10:
+            return 'y', 'x'
+        ydim, xdim = 'y_%im' % xres, 'x_%im' % xres
+        if xdim not in ncout.dimensions:
+            for dim, size, start, res in [(xdim, dataset.RasterXSize, ulx, xres),
+                                          (ydim, dataset.RasterYSize, uly, yres)]:
+                ncout.createDimension(dim, size)
+                ncdim = ncout.createVariable(dim, 'i4', dim, zlib=True)
+                ncdim.units = 'm'
+                ncdim.standard_name = 'projection_%s_coordinate' % dim[0]
+                ncdim[:] = np.arange(size) * res + start
+        return ydim, xdim
 
     def genLatLon(self, nx, ny, latlon=True):
         """ Method providing latitude and longitude arrays or projection
@@ -605,26 +937,124 @@ class Sentinel2_reader_and_NetCDF_converter:
         if not latlon:
             return xnp, ynp
 
-        # Generate coordinate mesh (UTM) Correct lat lon for center pixel
-        indices = np.indices((nx, ny), dtype=np.int32)
-        xp = np.int32(ulx + (xres * 0.5)) + indices[1] * np.int32(xres) + indices[1] * np.int32(
-            xskew)
-        yp = np.int32(uly - (yres * 0.5)) + indices[0] * np.int32(yres) + indices[0] * np.int32(
-            yskew)
+        return self.getLatLonTile(0, nx, 0, ny)
+
+    def getLatLonTile(self, row_start, row_stop, col_start, col_stop, geotransform=None,
+                      projection=None):
+        """ Method providing latitude and longitude arrays of a tile of the grid, for the center
+            of the pixels.
+
+        Keyword arguments:
+        row_start, row_stop -- rows of the tile
+        col_start, col_stop -- columns of the tile
+        geotransform, projection -- of the reference band, read from it if not given
+
+        Returns: latitude, longitude
+        """
+        if geotransform is None:
+            geotransform = self.reference_band.GetGeoTransform()
+        ulx, xres, xskew, uly, yskew, yres = geotransform
+
+        # Coordinate mesh (UTM) of the tile, computed as int32 as for the whole grid
+        rows = np.arange(row_start, row_stop, dtype=np.int32)[:, np.newaxis]
+        cols = np.arange(col_start, col_stop, dtype=np.int32)[np.newaxis, :]
+        xp = np.int32(ulx + (xres * 0.5)) + cols * np.int32(xres) + cols * np.int32(xskew)
+        yp = np.int32(uly - (yres * 0.5)) + rows * np.int32(yres) + rows * np.int32(yskew)
+        xp, yp = np.broadcast_arrays(xp, yp)
+
+        longitude, latitude = self.getTransformer(projection).transform(xp, yp)
+        return latitude, longitude
 
+    def getTransformer(self, projection=None):
+        """ Method returning the pyproj Transformer from the tile projection to longitude /
+            latitude. Transformers are cached per thread and per projection, since they
+            should not be shared between threads.
+
+        Keyword arguments:
+        projection -- WKT projection, of the reference band if not given
+        """
+        if projection is None:
+            projection = self.reference_band.GetProjection()
         source = osr.SpatialReference()
-        source.ImportFromWkt(self.reference_band.GetProjection())
+        source.ImportFromWkt(projection)
         target = osr.SpatialReference()
         # target.ImportFromEPSG(4326)
         target.ImportFromProj4('+proj=longlat +ellps=WGS84')
 
-        current_projection = pyproj.Proj(source.ExportToProj4())
-        target_projection = pyproj.Proj(target.ExportToProj4())
-        target2 = current_projection.to_latlong()
+        key = (source.ExportToProj4(), target.ExportToProj4())
+        transformers = _transformers.__dict__.setdefault('cache', {})
+        if key not in transformers:
+            transformers[key] = pyproj.Transformer.from_proj(pyproj.Proj(key[0]),
+                                                             pyproj.Proj(key[1]))
+        return transformers[key]
 
-        longitude, latitude = pyproj.transform(current_projection, target_projection, xp, yp)
+    def addLatLon(self, ncout, nx, ny, compression_level, chunk_size, workers=1):
+        """ Method adding latitude and longitude variables.
 
-        return latitude, longitude
+        Keyword arguments:
+        ncout -- NetCDF output file (already open), with x and y dimensions
+        nx, ny -- grid size
+        compression_level -- compression level on output NetCDF file (1-9)
+        chunk_size -- chunk_size
+        workers -- number of threads computing tiles
+        """
+        nclat = ncout.createVariable('lat','f4',('y','x',),zlib=True,complevel=compression_level, chunksizes=chunk_size[1:])
+        nclon = ncout.createVariable('lon','f4',('y','x',),zlib=True,complevel=compression_level, chunksizes=chunk_size[1:])
+        self.writeLatLon(nclat, nclon, nx, ny, workers) #Assume gcps are on a regular grid
+        nclat.long_name = 'latitude'
+        nclat.units = 'degrees_north'
+        nclat.standard_name = 'latitude'
+
+        nclon.long_name = 'longitude'
+        nclon.units = 'degrees_east'
+        nclon.standard_name = 'longitude'
+        return True
+
+    def writeLatLonFile(self, path, nx, ny, compression_level, chunk_size, workers=1):
+        """ Method writing a NetCDF file holding only the grid dimensions and lat/lon, used as
+            starting point of the output files of all products on this grid.
+
+        Keyword arguments:
+        path -- NetCDF file path
+        nx, ny -- grid size
+        compression_level -- compression level on output NetCDF file (1-9)
+        chunk_size -- chunk_size
+        workers -- number of threads computing tiles
+        """
+        with (netCDF4.Dataset(path, 'w', format='NETCDF4')) as ncout:
+            ncout.createDimension('time', 1)
+            ncout.createDimension('x', nx)
+            ncout.createDimension('y', ny)
+            self.addLatLon(ncout, nx, ny, compression_level, chunk_size, workers)
+        return True
+
+    def writeLatLon(self, nclat, nclon, nx, ny, workers=1):
+        """ Method writing latitude and longitude, tile by tile in the chunk shape of the
+            variables, without computing the whole grids at once.
+
+        Keyword arguments:
+        nclat, nclon -- latitude and longitude NetCDF variables
+        nx, ny -- grid size
+        workers -- number of threads computing tiles
+        """
+        chunk_shape = (1, 1)
+        if nclat.chunking() != 'contiguous':
+            chunk_shape = tuple(nclat.chunking())
+        windows = utils.copy_windows(nx, ny, chunk_shape, max_pixels=2 ** 22)
+        # Gdal objects are not shared with the worker threads
+        geotransform = self.reference_band.GetGeoTransform()
+        projection = self.reference_band.GetProjection()
+
+        def writeTile(target, window):
+            xoff, yoff, xcount, ycount = window
+            lat, lon = self.getLatLonTile(yoff, yoff + ycount, xoff, xoff + xcount,
+                                          geotransform, projection)
+            target(nclat)[yoff:yoff + ycount, xoff:xoff + xcount] = lat
+            target(nclon)[yoff:yoff + ycount, xoff:xoff + xcount] = lon
+
+        utils.run_writer_tasks([lambda target, window=window: writeTile(target, window)
+                                for window in windows], workers)
+        return True
 
     def list_product_structure(self):
         """ Traverse SAFE file structure (or any file structure) and
@@ -640,7 +1070,16 @@ class Sentinel2_reader_and_NetCDF_converter:
         elements = {root_path: ET_root}
 
         # Iterate throgh the file structure
-        for root, dirs, files in os.walk(startpath):
+        if self.archive is not None:
+            walk = self.archive.walk(self.SAFE_dir)
+        elif self.extract == 'needed':
+            # Not all files were extracted, list them from the zip file
+            archive = utils.SafeArchive(self.input_zip, self.SAFE_dir)
+            walk = list(archive.walk(self.SAFE_dir))
+            archive.close()
+        else:
+            walk = os.walk(startpath)
+        for root, dirs, files in walk:
             level = root.replace(startpath, '').count(os.sep)
             current_xpath = str('/' + root_path + root.replace(startpath, ''))
             current_path = root.replace(startpath, '')
@@ -658,6 +1097,67 @@ class Sentinel2_reader_and_NetCDF_converter:
         return ET.tostring(ET_root)
 
 
+def rasterize_vector_layer(nx, ny, gmlfile, geotransform):
+    """ Rasterize a GML mask file on a 10m grid. Module level function, so that masks can
+        be rasterized in a process pool.
+
+    Keyword arguments:
+    nx, ny -- grid size
+    gmlfile -- GML file
+    geotransform -- geotransform of the grid
+
+    Returns: rasterized_ok, {flag meaning: flag value}, mask array
+    """
+
+    # Open the data source and read in the extent
+    NoData_value = 0
+
+    source_ds = ogr.Open(str(gmlfile))
+    source_layer = source_ds.GetLayer()
+    # Check that gml file contains features
+    if source_layer is None:
+        return False, None, None
+
+    dst_ds = gdal.GetDriverByName('MEM').Create('', nx, ny, 1, gdal.GDT_Byte)
+    dst_rb = dst_ds.GetRasterBand(1)
+    dst_rb.SetNoDataValue(NoData_value)
+    dst_ds.SetGeoTransform(geotransform)
+
+    # Copy features to an in-memory layer, with their burn value as attribute, in the
+    # order they were burnt one by one before
+    burn_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    burn_layer = burn_ds.CreateLayer('burn', source_layer.GetSpatialRef())
+    burn_layer.CreateField(ogr.FieldDefn('burn', ogr.OFTInteger))
+    flag_values = []
+    flag_meanings = []
+    for i in range(0, source_layer.GetFeatureCount()):
+        feat = source_layer.GetFeature(i)
+        name = feat.GetField('gml_id')
+        if 'OPAQUE' in name:
+            value = int(name.split('.')[-1]) + 1
+        else:
+            value = int(name[-1]) + 1
+        burn_feat = ogr.Feature(burn_layer.GetLayerDefn())
+        burn_feat.SetGeometry(feat.GetGeometryRef())
+        burn_feat.SetField('burn', value)
+        burn_layer.CreateFeature(burn_feat)
+        flag_values.append(value)
+        flag_meanings.append(name)
+
+    gdal.RasterizeLayer(dst_ds, [1], burn_layer, options=['ATTRIBUTE=burn'])
+    burn_ds = None
+
+    dst_ds.FlushCache()
+    mask_arr = dst_ds.GetRasterBand(1).ReadAsArray()
+    dst_ds = None
+
+    # order flags for easier comparison
+    sorted_pairs = sorted(zip(flag_meanings, flag_values))
+    layer_mask = dict(sorted_pairs)
+
+    return True, layer_mask, mask_arr
+
+
 if __name__ == '__main__':
 
     workdir = pathlib.Path('/home/elodief/Data/NBS')
@@ -0,0 +1,65 @@
+"""
+SafeCache shared by several processes: products in use are never removed by eviction.
+"""
+
+import multiprocessing
+import random
+import time
+
+from safe_to_netcdf import utils
+
+PRODUCTS = [f'S2A_TEST_{i}.all.0123456789abcdef' for i in range(4)]
+PRODUCT_SIZE = 10000
+
+
+def build(path):
+    # Slow extraction, so that other processes wait for it or try to evict meanwhile
+    time.sleep(0.01)
+    (path / 'product.SAFE').mkdir()
+    (path / 'product.SAFE' / 'data').write_bytes(path.name.encode().ljust(PRODUCT_SIZE))
+
+
+def use_products(directory, seed, rounds):
+    """ Acquire random products and check they stay complete while held.
+        Returns the number of errors. """
+    rng = random.Random(seed)
+    cache = utils.SafeCache(directory, 2 * PRODUCT_SIZE)
+    errors = 0
+    for _ in range(rounds):
+        key = rng.choice(PRODUCTS)
+        path = cache.acquire(key, build)
+        for _ in range(3):
+            data = path / 'product.SAFE' / 'data'
+            if not data.is_file() or data.read_bytes().rstrip() != key.encode():
+                errors += 1
+            time.sleep(rng.random() * 0.005)
+        cache.release(key)
+    return errors
+
+
+def evict_products(directory, rounds):
+    cache = utils.SafeCache(directory, 0)
+    removed = 0
+    for _ in range(rounds):
+        removed += cache.evict()
+        time.sleep(0.001)
+    return removed
+
+
+def test_products_in_use_never_evicted(tmp_path):
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(6) as pool:
+        users = [pool.apply_async(use_products, (tmp_path, seed, 40)) for seed in range(5)]
+        evictor = pool.apply_async(evict_products, (tmp_path, 200))
+        assert [user.get(timeout=300) for user in users] == [0] * 5
+        assert evictor.get(timeout=300) > 0
+
+    # Products left are complete, and files of removed products are all removed
+    stats = utils.SafeCache(tmp_path, 2 * PRODUCT_SIZE).stats()
+    assert stats['hits'] + stats['misses'] == 5 * 40
+    for path in tmp_path.iterdir():
+        if path.name in ['cache.lock', 'stats.json']:
+            continue
+        key = path.name[:-len(path.suffix)] if path.suffix in ['.done', '.lock'] else path.name
+        assert (tmp_path / (key + '.done')).is_file()
+        assert (tmp_path / key / 'product.SAFE' / 'data').is_file()
@@ -3,22 +3,42 @@ Tools
 """
 
 import pathlib
+import hashlib
+import io
+import os
 import lxml.etree as ET
 import datetime as dt
+import math
 import resource
 from osgeo import gdal
 import subprocess as sp
+import safe_to_netcdf.constants as cst
 import zipfile
+import queue
+import collections
+import shutil
+import tempfile
+import json
+import fcntl
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
-def xml_read(xml_file):
+def xml_read(xml_file, archive=None):
     """
     Read XML file.
     Args:
         xml_file [pathlib]): filepath to an xml file
+        archive: SafeArchive to read the file from, if the product is not extracted
     Returns:
         lxml.etree._Element or None if file missing
     """
+    if archive is not None:
+        if not archive.is_file(xml_file):
+            print(f'Error: Can\'t find xmlfile {xml_file} in {archive.input_zip}')
+            return None
+        return ET.fromstring(archive.read(xml_file))
     if not pathlib.Path(xml_file).is_file():
         print(f'Error: Can\'t find xmlfile {xml_file}')
         return None
@@ -27,6 +47,676 @@ def xml_read(xml_file):
     return root
 
 
+class SafeArchive:
+    """
+    Read access to the files of a zipped SAFE product, without extracting it.
+    Files are given by the path they would have once extracted (in SAFE_dir), and read with
+    zipfile, or by GDAL through /vsizip/ paths.
+    """
+
+    def __init__(self, input_zip, SAFE_dir):
+        self.input_zip = pathlib.Path(input_zip)
+        self.root = pathlib.Path(SAFE_dir).parent
+        self.zip = zipfile.ZipFile(self.input_zip)
+        self.members = {info.filename: info for info in self.zip.infolist()}
+
+    def member(self, path):
+        """ Name in the zip file of an extracted path """
+        return pathlib.Path(path).relative_to(self.root).as_posix()
+
+    def is_file(self, path):
+        try:
+            return self.member(path) in self.members
+        except ValueError:
+            return False
+
+    def size(self, path):
+        return self.members[self.member(path)].file_size
+
+    def read(self, path):
+        return self.zip.read(self.member(path))
+
+    def open(self, path):
+        """ Binary file object """
+        return self.zip.open(self.member(path))
+
+    def gdal_path(self, path):
+        return f'/vsizip/{self.input_zip}/{self.member(path)}'
+
+    def namelist(self):
+        return list(self.members)
+
+    def close(self):
+        self.zip.close()
+
+    def walk(self, path):
+        """
+        Same as os.walk over an extracted directory, built from the zip central directory.
+        Args:
+            path: extracted directory path
+        Returns:
+            iterator over (directory path as string, subdirectory names, file names)
+        """
+        top = self.member(path)
+        dirs = {'': {}}
+        files = {'': []}
+        for name in self.members:
+            if not name.startswith(top + '/'):
+                continue
+            parts = name[len(top) + 1:].rstrip('/').split('/')
+            for i, part in enumerate(parts):
+                parent = '/'.join(parts[:i])
+                if i < len(parts) - 1 or name.endswith('/'):
+                    child = '/'.join(parts[:i + 1])
+                    dirs[parent][part] = None
+                    dirs.setdefault(child, {})
+                    files.setdefault(child, [])
+                elif part:
+                    files[parent].append(part)
+
+        def visit(current):
+            yield str(path) + ('/' + current if current else ''), list(dirs[current]), \
+                files[current]
+            for child in dirs[current]:
+                yield from visit(current + '/' + child if current else child)
+
+        return visit('')
+
+
+class XmlStore:
+    """
+    Parse-once store of XML documents, shared by all readers of a product.
+    Each file is parsed the first time it is requested (through xml_read) and the same
+    root element is returned afterwards. Counts parses and bytes read.
+    """
+
+    def __init__(self, archive=None):
+        self.archive = archive
+        self.documents = {}
+        self.parses = 0
+        self.bytes_read = 0
+
+    def get(self, xml_file):
+        """
+        Args:
+            xml_file [pathlib]): filepath to an xml file
+        Returns:
+            lxml.etree._Element or None if file missing
+        """
+        key = str(xml_file)
+        if key not in self.documents:
+            root = xml_read(xml_file, self.archive)
+            if root is not None:
+                self.parses += 1
+                if self.archive is not None:
+                    self.bytes_read += self.archive.size(xml_file)
+                else:
+                    self.bytes_read += pathlib.Path(xml_file).stat().st_size
+            self.documents[key] = root
+        return self.documents[key]
+
+    def __str__(self):
+        return f'{self.parses} xml files parsed, {self.bytes_read / 1000000:.1f} Mb read'
+
+
+class QueuedTarget:
+    """
+    Stand-in for a NetCDF variable written from a worker thread. Assignments are put on a
+    queue and done by the writer thread, since netCDF4 handles are not thread safe.
+    Shape and chunking of the variable are read once, while holding the writer lock.
+    """
+
+    def __init__(self, variable, pending, lock):
+        self.variable = variable
+        self.pending = pending
+        with lock:
+            self.shape = variable.shape
+            self.chunks = variable.chunking() if hasattr(variable, 'chunking') else None
+
+    def chunking(self):
+        return self.chunks
+
+    def __setitem__(self, key, value):
+        self.pending.put((self.variable, key, value))
+
+
+def run_writer_tasks(tasks, workers=1, max_pending=8):
+    """
+    Run tasks writing to NetCDF variables, in a pool of threads with a single writer.
+    Args:
+        tasks: functions taking a target function, which returns the object to write into
+               for a NetCDF variable
+        workers: number of threads. With 1, tasks are run in turn and write directly.
+        max_pending: maximum number of assignments waiting for the writer
+    Returns:
+        list of task results
+    """
+    if workers <= 1:
+        return [task(lambda variable: variable) for task in tasks]
+
+    pending = queue.Queue(max_pending)
+    lock = threading.Lock()
+
+    def run(task):
+        try:
+            return task(lambda variable: QueuedTarget(variable, pending, lock))
+        finally:
+            pending.put(None)
+
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run, task) for task in tasks]
+        finished = 0
+        while finished < len(tasks):
+            item = pending.get()
+            if item is None:
+                finished += 1
+            elif error is None:
+                # After an error, keep emptying the queue so that no worker stays blocked
+                variable, key, value = item
+                try:
+                    with lock:
+                        variable[key] = value
+                except Exception as e:
+                    error = e
+    if error is not None:
+        raise error
+    return [future.result() for future in futures]
+
+
+class FileCache:
+    """
+    Directory of files reused from one product to the next (e.g. lat/lon grids of a tile),
+    kept under a size budget. Least recently used files are removed first.
+    """
+
+    def __init__(self, directory, max_bytes, suffix='.nc'):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Args:
+            parts: values identifying a file (must have a stable repr)
+        Returns:
+            hexadecimal digest of the values
+        """
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Args:
+            key: file key
+        Returns:
+            path to the cached file, or None if not cached
+        """
+        path = self.directory / (key + self.suffix)
+        try:
+            # Modification time is used as last access time
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def add(self, key, build):
+        """
+        Create a cached file, then remove the least recently used files above the budget.
+        Args:
+            key: file key
+            build: function writing the file, given its path
+        Returns:
+            path to the cached file
+        """
+        path = self.directory / (key + self.suffix)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        try:
+            build(tmp)
+            # Atomic, so that other processes never see partial files
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        self.evict(keep=path)
+        return path
+
+    def copy(self, key, destination, build):
+        """
+        Copy a cached file, creating it first if not cached. Files removed by another process
+        sharing the cache before being copied are created again.
+        Args:
+            key: file key
+            destination: path of the copy
+            build: function writing the file, given its path
+        """
+        path = self.get(key)
+        if path is not None:
+            try:
+                shutil.copyfile(path, destination)
+                return
+            except FileNotFoundError:
+                self.hits -= 1
+                self.misses += 1
+        path = self.add(key, build)
+        try:
+            shutil.copyfile(path, destination)
+        except FileNotFoundError:
+            # Removed again, not worth a third attempt
+            build(destination)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits in its budget.
+        Args:
+            keep: path never removed
+        Returns:
+            number of removed files
+        """
+        files = []
+        for path in self.directory.glob('*' + self.suffix):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def __str__(self):
+        return f'{self.hits} hits, {self.misses} misses in {self.directory}'
+
+
+class SafeCache:
+    """
+    Work area where SAFE products are extracted, shared by several conversion processes and
+    kept under a size budget. Each product is extracted once in a directory named by its key,
+    and the least recently used directories are removed first.
+    Products in use are held with a shared file lock (fcntl), released by release() or when
+    the process exits, so that they are never removed while another process reads them.
+    Lock files are removed with their products.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.held = {}  # key: file descriptor of the lock held on the product
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(product_id, checksum, extract=True):
+        """
+        Args:
+            product_id: SAFE product name
+            checksum: checksum of the zip file (see zip_checksum)
+            extract: extraction mode, products partly extracted are stored apart
+        Returns:
+            directory name of the product in the cache
+        """
+        mode = 'needed' if extract == 'needed' else 'all'
+        return f'{product_id}.{mode}.{checksum[:16]}'
+
+    def lock(self, name, flags=fcntl.LOCK_EX):
+        """
+        Args:
+            name: lock file name
+            flags: fcntl.flock operation
+        Returns:
+            file descriptor holding the lock, None if non-blocking and already locked
+        """
+        while True:
+            fd = os.open(self.directory / name, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, flags)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            if self.is_current(fd, name):
+                return fd
+            # Removed with its product while waiting for the lock, lock the new file
+            os.close(fd)
+
+    def is_current(self, fd, name):
+        """
+        Args:
+            fd: file descriptor of a lock file
+            name: lock file name
+        Returns:
+            True if the lock file was not removed (by evict) since it was opened
+        """
+        try:
+            return os.fstat(fd).st_ino == os.stat(self.directory / name).st_ino
+        except FileNotFoundError:
+            return False
+
+    def acquire(self, key, build):
+        """
+        Get a product from the cache, extracting it if needed, and hold it until release().
+        Args:
+            key: product key
+            build: function extracting the product, given the directory
+        Returns:
+            path to the product directory
+        """
+        if key in self.held:
+            return self.directory / key
+        path = self.directory / key
+        # Marker written once extraction is complete, holding the size of the product
+        done = self.directory / (key + '.done')
+        while True:
+            # Shared lock: other processes may use the product, but not remove it
+            fd = self.lock(key + '.lock', fcntl.LOCK_SH)
+            try:
+                hit = done.exists()
+                if not hit:
+                    # Exclusive lock to extract, then check again as the lock is released
+                    # while converted, and another process may have extracted or removed the
+                    # product meanwhile
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    if not self.is_current(fd, key + '.lock'):
+                        os.close(fd)
+                        continue
+                    hit = done.exists()
+                    if not hit:
+                        # Left over by an interrupted extraction
+                        shutil.rmtree(path, ignore_errors=True)
+                        path.mkdir()
+                        build(path)
+                        size = sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+                        done.write_text(str(size))
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                    if not done.exists() or not self.is_current(fd, key + '.lock'):
+                        os.close(fd)
+                        continue
+                # Modification time of the marker is used as last access time
+                os.utime(done)
+            except BaseException:
+                os.close(fd)
+                raise
+            break
+        self.held[key] = fd
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.update_stats(hit)
+        print(f'{"Found" if hit else "Extracted"} {key} in SAFE cache')
+        self.evict()
+        return path
+
+    def release(self, key):
+        """
+        Let other processes remove a product.
+        Args:
+            key: product key
+        """
+        fd = self.held.pop(key, None)
+        if fd is not None:
+            os.close(fd)
+
+    def evict(self):
+        """
+        Remove the least recently used products not in use until the cache fits in its budget.
+        Returns:
+            number of removed products
+        """
+        fd = self.lock('cache.lock')
+        try:
+            products = []
+            for done in self.directory.glob('*.done'):
+                try:
+                    products.append((done.stat().st_mtime, int(done.read_text()), done))
+                except (FileNotFoundError, ValueError):
+                    continue
+            products.sort()
+            total = sum(size for _, size, _ in products)
+            removed = 0
+            for _, size, done in products:
+                if total <= self.max_bytes:
+                    break
+                key = done.name[:-len('.done')]
+                if key in self.held:
+                    continue
+                # Skip products used or being extracted by other processes
+                product_fd = self.lock(key + '.lock', fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if product_fd is None:
+                    continue
+                try:
+                    done.unlink()
+                    shutil.rmtree(self.directory / key, ignore_errors=True)
+                    # Processes waiting for the lock see it removed, and lock a new file
+                    os.unlink(self.directory / (key + '.lock'))
+                finally:
+                    os.close(product_fd)
+                total -= size
+                removed += 1
+            if removed:
+                self.evictions += removed
+                self.update_stats(evictions=removed, locked=True)
+        finally:
+            os.close(fd)
+        return removed
+
+    def update_stats(self, hit=None, evictions=0, locked=False):
+        """
+        Add to the statistics of all processes using the cache, kept in stats.json.
+        Args:
+            hit: True for a hit, False for a miss, None for neither
+            evictions: number of removed products
+            locked: True if the cache lock is already held
+        """
+        fd = None if locked else self.lock('cache.lock')
+        try:
+            stats = self.stats()
+            if hit is not None:
+                stats['hits' if hit else 'misses'] += 1
+            stats['evictions'] += evictions
+            tmp = self.directory / f'stats.json.{os.getpid()}.tmp'
+            tmp.write_text(json.dumps(stats))
+            os.replace(tmp, self.directory / 'stats.json')
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def stats(self):
+        """
+        Returns:
+            dictionary of hits, misses and evictions of all processes using the cache
+        """
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        try:
+            stats.update(json.loads((self.directory / 'stats.json').read_text()))
+        except (FileNotFoundError, ValueError):
+            pass
+        return stats
+
+    def __str__(self):
+        total = self.stats()
+        return (f'{self.hits} hits, {self.misses} misses, {self.evictions} evictions in '
+                f'{self.directory} ({total["hits"]} hits, {total["misses"]} misses, '
+                f'{total["evictions"]} evictions in all)')
+
+
+class LazyAttribute:
+    """
+    Attribute of a reader computed on first access, with the other attributes of its group,
+    by the reader method named loader (see load). Readers define reader.lock (RLock),
+    reader.loaded and reader.loading (sets of loader names).
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, reader, owner=None):
+        if reader is None:
+            return self
+        if self.loader not in reader.loaded:
+            load(reader, self.loader)
+        try:
+            return reader.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, reader, value):
+        reader.__dict__[self.name] = value
+
+
+def load(self, loader):
+    """
+    Run a loader method of a reader once. Other threads wait until it is done, so that they
+    never see a group of attributes partly loaded, while the loader itself and the loaders it
+    triggers read the attributes being loaded.
+    Args:
+        loader: name of the method
+    """
+    with self.lock:
+        if loader in self.loaded or loader in self.loading:
+            return
+        self.loading.add(loader)
+        try:
+            getattr(self, loader)()
+        finally:
+            self.loading.discard(loader)
+        self.loaded.add(loader)
+
+
+def map_in_processes(function, arguments, workers=1):
+    """
+    Call a module level function on each set of arguments, in a pool of processes.
+    Args:
+        function: function to call
+        arguments: list of argument tuples
+        workers: number of processes. With 1, calls are done in turn in this process.
+            Processes are started from a fork server, not forked from this process, so that
+            they do not inherit its open files (NetCDF output, gdal datasets) nor the locks held
+            by its threads.
+    Returns:
+        iterator over the results, in the order of the arguments. Only about workers calls
+        are pending at a time, so that large results do not pile up while they are consumed.
+    """
+    if workers <= 1 or len(arguments) <= 1:
+        yield from (function(*args) for args in arguments)
+        return
+    workers = min(workers, len(arguments))
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('forkserver')) as executor:
+        pending = collections.deque()
+        for args in arguments:
+            if len(pending) == workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, *args))
+        while pending:
+            yield pending.popleft().result()
+
+
+def copy_windows(xsize, ysize, chunk_shape=(1, 1), block_shape=(1, 1), max_pixels=2 ** 24):
+    """
+    Split a raster in windows aligned to both the output chunks and the source blocks.
+    Windows span the full width when they fit in max_pixels.
+    Args:
+        xsize, ysize: raster size
+        chunk_shape: (y, x) output chunk shape
+        block_shape: (y, x) source block shape
+        max_pixels: maximum number of pixels in a window
+    Returns:
+        list of (xoff, yoff, xcount, ycount)
+    """
+    # Align to both chunks and blocks when affordable, to the chunks only otherwise
+    step_x = min(math.lcm(chunk_shape[1], block_shape[1]), xsize)
+    step_y = min(math.lcm(chunk_shape[0], block_shape[0]), ysize)
+    if step_y * step_x > max_pixels:
+        step_y = min(chunk_shape[0], ysize)
+    if step_y * step_x > max_pixels:
+        step_x = min(chunk_shape[1], xsize)
+    window_x = xsize
+    if step_y * xsize > max_pixels:
+        window_x = min(step_x * max(1, max_pixels // (step_y * step_x)), xsize)
+    window_y = min(step_y * max(1, max_pixels // (step_y * window_x)), ysize)
+    return [(xoff, yoff, min(window_x, xsize - xoff), min(window_y, ysize - yoff))
+            for yoff in range(0, ysize, window_y) for xoff in range(0, xsize, window_x)]
+
+
+def upsample_blocks(data, factor):
+    """
+    Upsample the last two (y, x) dimensions of an array by an integer factor, each value
+    being repeated over a factor x factor block.
+    Upsampling by 2 gives the same output as scipy.ndimage.zoom with order=0 (not by 6).
+    Args:
+        data: numpy array
+        factor: integer upsampling factor
+    Returns:
+        numpy array
+    """
+    if factor == 1:
+        return data
+    return data.repeat(factor, axis=-2).repeat(factor, axis=-1)
+
+
+def copy_band(band, target, index=(), max_pixels=2 ** 24, factor=1, convert=None):
+    """
+    Copy a GDAL raster band to a NetCDF variable, window by window, instead of mapping
+    and writing the whole band at once. Windows are read with ReadAsArray and aligned to
+    the variable chunks and the band blocks.
+    Args:
+        band: gdal raster band, or gdal dataset to read all bands at once
+        target: NetCDF variable (or array) with the band as its last two (y, x) dimensions
+        index: indices of target before (y, x), e.g. (0,) for a (time, y, x) variable
+        max_pixels: maximum number of pixels read at once
+        factor: integer upsampling factor from the band to target (block replication)
+        convert: function applied to each window read, e.g. to combine bands of a dataset
+    Returns:
+        True
+    """
+    chunk_shape = (1, 1)
+    chunking = getattr(target, 'chunking', None)
+    if chunking and chunking() not in [None, 'contiguous']:
+        chunk_shape = tuple(chunking()[-2:])
+    # Source windows giving output windows aligned to the chunks
+    chunk_shape = tuple(c // math.gcd(c, factor) for c in chunk_shape)
+    ysize, xsize = target.shape[-2:]
+    if hasattr(band, 'RasterXSize'):
+        band_xsize, band_ysize = band.RasterXSize, band.RasterYSize
+        block_x, block_y = band.GetRasterBand(1).GetBlockSize()
+    else:
+        band_xsize, band_ysize = band.XSize, band.YSize
+        block_x, block_y = band.GetBlockSize()
+    for xoff, yoff, xcount, ycount in copy_windows(band_xsize, band_ysize, chunk_shape,
+                                                   (block_y, block_x),
+                                                   max(1, max_pixels // factor ** 2)):
+        data = band.ReadAsArray(xoff, yoff, xcount, ycount)
+        if convert is not None:
+            data = convert(data)
+        data = upsample_blocks(data, factor)
+        y0, x0 = yoff * factor, xoff * factor
+        y1, x1 = min(y0 + data.shape[0], ysize), min(x0 + data.shape[1], xsize)
+        target[tuple(index) + (slice(y0, y1), slice(x0, x1))] = data[:y1 - y0, :x1 - x0]
+    return True
+
+
 def memory_use(start_time):
     """
     Print memory usage and time taken by a process.
@@ -85,7 +775,7 @@ def initializer(self):
      - ...
     Returns: True
     """
-    root = xml_read(self.mainXML)
+    root = xml_read(self.mainXML, self.archive)
     sat = self.product_id.split('_')[0][0:2]
 
     # List of xml / gml files
@@ -94,7 +784,10 @@ def initializer(self):
         self.xmlFiles['mainXML'] = self.SAFE_dir / 'MTD_MSIL1C.xml'
         # For DTERR data, add manually the list of images / xml-gml files from parsing the SAFE
         # directory
-        allFiles = zipfile.ZipFile(self.input_zip).namelist()
+        if self.archive is not None:
+            allFiles = self.archive.namelist()
+        else:
+            allFiles = zipfile.ZipFile(self.input_zip).namelist()
         for f in allFiles:
             fWithPath = self.SAFE_dir.parent / f
             if fWithPath.suffix == '.xml' or fWithPath.suffix == '.gml':
@@ -128,9 +821,10 @@ def initializer(self):
 
     # Set gdal object
     if sat == 'S2' and not self.dterrengdata:
-        gdalFile = str(self.xmlFiles['S2_{}_Product_Metadata'.format(self.processing_level)])
+        gdalFile = gdal_path(self, self.xmlFiles['S2_{}_Product_Metadata'.format(
+            self.processing_level)])
     else:
-        gdalFile = str(self.mainXML)
+        gdalFile = gdal_path(self, self.mainXML)
     self.src = gdal.Open(gdalFile)
     if self.src is None:
         raise
@@ -164,23 +858,114 @@ def initializer(self):
     return True
 
 
+def plan_extraction(archive, SAFE_dir):
+    """
+    Select the members of a SAFE zip file read by the converters, from the data objects of
+    its manifest (see initializer): the manifest itself, and the xml / gml files and images
+    they are given. Products without manifest (dterreng data) are listed the same way as in
+    initializer, from the files of the zip.
+    Args:
+        archive: SafeArchive of the product
+        SAFE_dir: SAFE directory the product is extracted to
+    Returns:
+        list of zipfile.ZipInfo
+    """
+    manifest = SAFE_dir / 'manifest.safe'
+    if not archive.is_file(manifest):
+        # dterreng data
+        return [member for name, member in archive.members.items()
+                if pathlib.PurePosixPath(name).suffix in ['.xml', '.gml'] or
+                ('.jp2' in name and 'IMG_DATA' in name)]
+
+    needed = [archive.member(manifest)]
+    root = xml_read(manifest, archive)
+    for dataObject in root.find('./dataObjectSection').findall('./'):
+        ftype = None
+        href = None
+        for element in dataObject.iter():
+            attrib = element.attrib
+            if 'mimeType' in attrib:
+                ftype = attrib['mimeType']
+            if 'href' in attrib:
+                href = attrib['href'][1:]
+        if ftype in cst.safe_data_mime_types and href:
+            needed.append(archive.member(SAFE_dir / href[1:]))
+    return [archive.members[name] for name in dict.fromkeys(needed) if name in archive.members]
+
+
+def extract_members(input_zip, members, destination, workers=4):
+    """
+    Extract members of a zip file with several threads, each with its own zip file handle.
+    Args:
+        input_zip: zip file path
+        members: list of zipfile.ZipInfo to extract
+        destination: directory to extract to
+        workers: number of threads
+    Returns:
+        True
+    """
+    # Share the biggest members between threads first
+    members = sorted(members, key=lambda member: member.file_size, reverse=True)
+    shares = [members[i::workers] for i in range(workers)]
+
+    # Created beforehand: zipfile creates missing directories without exist_ok, and fails
+    # when two threads create the same directory at the same time
+    directories = set()
+    for member in members:
+        path = pathlib.Path(destination) / member.filename
+        directories.add(path if member.is_dir() else path.parent)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    def extract(share):
+        with zipfile.ZipFile(input_zip) as archive:
+            for member in share:
+                archive.extract(member, destination)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(extract, [share for share in shares if share]))
+    return True
+
+
 def uncompress(self):
     """
-    Uncompress a SAFE zip file.
+    Uncompress a SAFE zip file, depending on self.extract:
+     - True: extract everything
+     - 'needed': extract only the files used by the converters (see plan_extraction), in a
+       directory of its own (<product>.needed), apart from full extractions
+     - False: do not extract, open it to be read in place
+    When self.cache is set (SafeCache), the product is extracted in this shared work area,
+    which cannot be used with extract=False (ValueError).
+    A SAFE directory already extracted is reused, self.extracted telling whether this reader
+    extracted it (and clean removes it).
     Find the main XML: manifest or other (dterreng data).
     Return: True
     """
 
-    # If zip not extracted yet
-    if not self.SAFE_dir.is_dir():
-        self.SAFE_dir.parent.mkdir(parents=False, exist_ok=True)
-        sp.run(["/usr/bin/unzip", self.input_zip, "-d", self.SAFE_dir.parent], check=True)
+    self.extracted = False
+    if not self.extract and self.cache is not None:
+        raise ValueError('A SAFE cache needs the product to be extracted, not read in place '
+                         '(extract=False)')
+    if not self.extract:
+        self.archive = SafeArchive(self.input_zip, self.SAFE_dir)
+    elif self.cache is not None:
+        # Extracted in the shared work area, once for all processes using it
+        key = self.cache.key(self.product_id, zip_checksum(self.input_zip), self.extract)
+        outdir = self.cache.acquire(key, lambda directory: extract_product(self, directory))
+        self.SAFE_dir = (outdir / self.product_id).with_suffix('.SAFE')
+    else:
+        if self.extract == 'needed':
+            self.SAFE_dir = self.SAFE_dir.parent / f'{self.product_id}.needed' / self.SAFE_dir.name
+        if not self.SAFE_dir.is_dir():
+            # If zip not extracted yet
+            self.SAFE_dir.parent.mkdir(parents=self.extract == 'needed', exist_ok=True)
+            self.extracted = extract_product(self, self.SAFE_dir.parent)
 
     # Try and find the main XML file
     xmlFile = self.SAFE_dir / 'manifest.safe'
-    if not xmlFile.is_file():
+    if not is_file(self, xmlFile):
         xmlFile = self.SAFE_dir / 'MTD_MSIL1C.xml'
-        if not xmlFile.is_file():
+        if not is_file(self, xmlFile):
             print(f'Main file not found. Exiting')
             raise
         self.dterrengdata = True
@@ -189,4 +974,116 @@ def uncompress(self):
     self.mainXML = xmlFile
     return True
 
-# Add function to clean work files?
+def extract_product(self, destination):
+    """
+    Extract the SAFE product, or only the files used by the converters if self.extract
+    is 'needed'. Files are extracted in a temporary directory, and moved to destination once
+    all are there, so that an interrupted extraction is never taken for a complete one.
+    Args:
+        destination: directory where the SAFE directory is created
+    Returns:
+        False if another process extracted the product in destination meanwhile, True otherwise
+    """
+    temporary = pathlib.Path(tempfile.mkdtemp(prefix=f'.{self.product_id}.',
+                                              dir=destination))
+    try:
+        extract_zip(self, temporary)
+        extracted = True
+        for path in temporary.iterdir():
+            try:
+                os.rename(path, pathlib.Path(destination) / path.name)
+            except OSError:
+                if not (pathlib.Path(destination) / path.name).exists():
+                    raise
+                extracted = False  # already moved there by another process
+    finally:
+        shutil.rmtree(temporary, ignore_errors=True)
+    return extracted
+
+
+def extract_zip(self, destination):
+    """
+    Extract the files of the SAFE product used with self.extract in destination.
+    Args:
+        destination: directory where the SAFE directory is created
+    """
+    if self.extract == 'needed':
+        archive = SafeArchive(self.input_zip, self.SAFE_dir)
+        try:
+            members = list(archive.members.values())
+            needed = plan_extraction(archive, self.SAFE_dir)
+        finally:
+            archive.close()
+        extract_members(self.input_zip, needed, destination,
+                        workers=min(8, os.cpu_count() or 1))
+        total = sum(member.file_size for member in members)
+        extracted = sum(member.file_size for member in needed)
+        print(f'Extracted {len(needed)} of {len(members)} files, '
+              f'{extracted / 1000000:.1f} Mb, {(total - extracted) / 1000000:.1f} Mb '
+              f'saved')
+    else:
+        sp.run(["/usr/bin/unzip", self.input_zip, "-d", destination], check=True)
+
+
+def zip_checksum(input_zip):
+    """
+    Checksum of a zip file from its central directory (names, sizes and CRCs of the
+    members), without reading the compressed data.
+    Args:
+        input_zip: path to the zip file
+    Returns:
+        hexadecimal digest
+    """
+    with zipfile.ZipFile(input_zip) as archive:
+        return FileCache.key(*[(member.filename, member.file_size, member.CRC)
+                               for member in archive.infolist()])
+
+
+def is_file(self, path):
+    """
+    Check that a file of the product exists, in the zip if the product is read in place.
+    Returns: boolean
+    """
+    if self.archive is not None:
+        return self.archive.is_file(path)
+    return pathlib.Path(path).is_file()
+
+
+def gdal_path(self, path):
+    """
+    Path to open a file of the product with GDAL / OGR: /vsizip/ path if the product is
+    read in place, else the path as a string.
+    Returns: string
+    """
+    if self.archive is not None:
+        return self.archive.gdal_path(path)
+    return str(path)
+
+
+def open_text(self, path):
+    """
+    Open a file of the product in text mode, from the zip if the product is read in place.
+    Returns: file object
+    """
+    if self.archive is not None:
+        return io.TextIOWrapper(self.archive.open(path))
+    return open(path, 'r')
+
+
+def clean(self):
+    """
+    Clean the work files of a converted product: release it in the shared work area if
+    it was extracted there (self.cache), remove the SAFE directory otherwise if this reader
+    extracted it. SAFE directories found already extracted are left in place.
+    """
+    if self.archive is not None:
+        self.archive.close()
+        self.archive = None
+    elif self.cache is not None:
+        self.cache.release(self.SAFE_dir.parent.name)
+    elif self.extracted:
+        shutil.rmtree(self.SAFE_dir)
+        if self.extract == 'needed':
+            self.SAFE_dir.parent.rmdir()
+        self.extracted = False
+        print(f'Removed {self.SAFE_dir}')